@@ -1,20 +1,22 @@
 from __future__ import annotations
 from abc import abstractmethod
 from enum import Enum
+import hashlib
+import os
 import pprint
-from typing import TYPE_CHECKING, Optional, Union
+import shutil
+import tempfile
+from typing import Any, Optional, Union
 import numpy as np
 import math
-from datasets import Dataset, DatasetDict
+from datasets import Dataset, DatasetDict, load_from_disk
+import torch
 import logging
 
 from transformer_document_embedding.datasets import col
 
 logger = logging.getLogger(__name__)
 
-if TYPE_CHECKING:
-    from typing import Any
-
 
 class EvaluationKind(Enum):
     RETRIEVAL = "retrieval"
@@ -29,7 +31,15 @@ class DocumentDataset:
 
     Wraps splits implemented as HuggingFace `Dataset` with some handy add
     features. Mainly adding ids to documents, and outsourcing validation split
-    from other splits."""
+    from other splits.
+
+    If `splits_cache_dir` is given, the created splits are saved there and
+    loaded on subsequent runs with the same configuration. Outsourced
+    validation splits are cached only if `validation_seed` is set. Only datasets
+    with `SPLITS_CACHEABLE` set support caching. The cache is keyed by fingerprints
+    of the retrieved data, so a changed source is never served stale splits."""
+
+    SPLITS_CACHEABLE = False
 
     def __init__(
         self,
@@ -39,6 +49,8 @@ class DocumentDataset:
         validation_source_fraction: Optional[float] = None,
         validation_source: Optional[str] = None,
         splits: Optional[dict[str, str]] = None,
+        validation_seed: Optional[int] = None,
+        splits_cache_dir: Optional[str] = None,
     ) -> None:
         self._data_size_limit = data_size_limit
 
@@ -46,17 +58,86 @@ class DocumentDataset:
         self._validation_fraction = validation_source_fraction
         self._validation_source = validation_source
         self._splits_transform = splits
+        self._validation_seed = validation_seed
+        self._splits_cache_dir = splits_cache_dir
         self._splits = None
 
+        if splits_cache_dir is not None and not self.SPLITS_CACHEABLE:
+            raise ValueError(
+                f"{self.__class__.__name__} does not support caching of its splits."
+            )
+
     @property
     def splits(self) -> DatasetDict:
         """Returns dictionary of all available splits."""
         if self._splits is None:
             dataset = self._retrieve_dataset()
-            self._splits = self._create_splits(dataset)
+            cache_path = self._splits_cache_path(dataset)
+            if cache_path is None:
+                self._splits = self._create_splits(dataset)
+            else:
+                self._splits = self._cached_splits(dataset, cache_path)
 
         return self._splits
 
+    def _cached_splits(self, dataset: DatasetDict, cache_path: str) -> DatasetDict:
+        distributed = (
+            torch.distributed.is_available() and torch.distributed.is_initialized()
+        )
+        is_main_process = not distributed or torch.distributed.get_rank() == 0
+
+        if is_main_process and not os.path.exists(cache_path):
+            assert self._splits_cache_dir is not None
+            os.makedirs(self._splits_cache_dir, exist_ok=True)
+            # Saved aside and moved into place, so that partially written splits
+            # are never loaded
+            tmp_path = tempfile.mkdtemp(prefix=".tmp-", dir=self._splits_cache_dir)
+            self._create_splits(dataset).save_to_disk(tmp_path)
+            try:
+                os.rename(tmp_path, cache_path)
+            except OSError:
+                # Another run has cached the same splits in the meantime
+                shutil.rmtree(tmp_path)
+
+        if distributed:
+            torch.distributed.barrier()
+
+        logger.info("Loading cached splits from '%s'.", cache_path)
+        splits = load_from_disk(cache_path)
+        assert isinstance(splits, DatasetDict)
+        return splits
+
+    def _splits_cache_path(self, dataset: DatasetDict) -> Optional[str]:
+        if self._splits_cache_dir is None:
+            return None
+
+        if (
+            self._validation_source is not None
+            and self._validation_fraction is not None
+            and self._validation_seed is None
+        ):
+            logger.warning(
+                "Splits are not cached, since validation split is random without"
+                " `validation_seed`."
+            )
+            return None
+
+        def _sorted(config: Any) -> Any:
+            return sorted(config.items()) if isinstance(config, dict) else config
+
+        split_config = (
+            self.__class__.__name__,
+            sorted((name, split._fingerprint) for name, split in dataset.items()),
+            _sorted(self._data_size_limit),
+            self._add_ids,
+            self._validation_source,
+            self._validation_fraction,
+            self._validation_seed,
+            _sorted(self._splits_transform),
+        )
+        fingerprint = hashlib.sha1(repr(split_config).encode()).hexdigest()
+        return os.path.join(self._splits_cache_dir, fingerprint)
+
     @property
     def evaluation_kind(self) -> EvaluationKind:
         """Returns identifier of the evaluation method of this dataset."""
@@ -69,15 +150,17 @@ class DocumentDataset:
 
     def _shorten_split(self, split: Dataset, size_limit: int) -> Dataset:
         if col.LABEL not in split.column_names:
+            # Contiguous range is selected as a zero-copy slice of the table
             return split.select(range(size_limit))
 
-        label_counts = {value: 0 for value in split.unique(col.LABEL)}
+        # Single columnar fetch instead of decoding every document
+        labels = np.asarray(split.with_format("numpy")[col.LABEL])
+        label_values, counts = np.unique(labels, return_counts=True)
 
-        for label in split[col.LABEL]:
-            label_counts[label] += 1
-
-        for value, count in label_counts.items():
-            label_counts[value] = math.floor(count / len(split) * size_limit)
+        label_counts = {
+            value: math.floor(count / len(split) * size_limit)
+            for value, count in zip(label_values.tolist(), counts, strict=True)
+        }
 
         while sum(label_counts.values()) < size_limit:
             value_with_min_count = min(
@@ -85,30 +168,32 @@ class DocumentDataset:
             )
             label_counts[value_with_min_count] += 1
 
-        selected_inds = []
-        for label_value, count in label_counts.items():
-            pool = (i for i, doc in enumerate(split) if doc[col.LABEL] == label_value)
-            for _, index in zip(range(count), pool, strict=False):
-                selected_inds.append(index)
+        selected_inds = np.concatenate(
+            [
+                np.flatnonzero(labels == label_value)[:count]
+                for label_value, count in label_counts.items()
+            ]
+        )
 
-        return split.select(selected_inds)
+        # Ascending indices keep reads sequential. The small indices mapping is
+        # kept in memory instead of being written to the cache.
+        return split.select(np.sort(selected_inds), keep_in_memory=True)
 
     def _shorten_splits(self, dataset: DatasetDict) -> DatasetDict:
         if self._data_size_limit is None:
             return dataset
 
-        if not isinstance(self._data_size_limit, dict):
-            self._data_size_limit = {
-                split_name: self._data_size_limit for split_name in dataset.keys()
-            }
+        size_limits = self._data_size_limit
+        if not isinstance(size_limits, dict):
+            size_limits = {split_name: size_limits for split_name in dataset.keys()}
 
         logger.info(
             "Shortening splits of %s to:\n%s",
             self.__class__.__name__,
-            pprint.pformat(self._data_size_limit, indent=1),
+            pprint.pformat(size_limits, indent=1),
         )
         for name, split in dataset.items():
-            limit = self._data_size_limit.get(name, None)
+            limit = size_limits.get(name, None)
             if limit is not None and len(split) > limit:
                 dataset[name] = self._shorten_split(split, limit)
 
@@ -137,13 +222,14 @@ class DocumentDataset:
         """Creates splits."""
         if self._add_ids:
             begin_id = 0
-
-            def map_fn(_, idx: int) -> dict[str, Any]:
-                return {"id": idx + begin_id}
-
             for name, split in dataset.items():
-                dataset[name] = split.map(map_fn, with_indices=True)
-                begin_id += len(dataset[name])
+                if col.ID in split.column_names:
+                    split = split.remove_columns(col.ID)
+
+                # Appending a column doesn't rewrite the rest of the split
+                ids = np.arange(begin_id, begin_id + len(split), dtype=np.int64)
+                dataset[name] = split.add_column(col.ID, ids)
+                begin_id += len(split)
 
         if (
             "validation" not in dataset
@@ -152,19 +238,22 @@ class DocumentDataset:
         ):
             validation_source = dataset[self._validation_source]
 
-            source_len = len(validation_source)
-            val_len = math.floor(source_len * self._validation_fraction)
-
-            all_indices = np.arange(source_len)
-            np.random.shuffle(all_indices)
-
-            val_indices = all_indices[:val_len]
-            new_source_indicies = all_indices[val_len:]
-
-            dataset["validation"] = validation_source.select(val_indices)
-            dataset[self._validation_source] = validation_source.select(
-                new_source_indicies
-            )
+            val_len = math.floor(len(validation_source) * self._validation_fraction)
+            if val_len > 0:
+                # Shuffles once and takes both parts as contiguous ranges of the
+                # permutation
+                parts = validation_source.train_test_split(
+                    test_size=val_len, shuffle=True, seed=self._validation_seed
+                )
+                dataset["validation"] = parts["test"]
+                dataset[self._validation_source] = parts["train"]
+            else:
+                logger.warning(
+                    "Validation fraction %s of split '%s' is empty, no validation"
+                    " split is created.",
+                    self._validation_fraction,
+                    self._validation_source,
+                )
 
         dataset = self._shorten_splits(dataset)
         dataset = self._transform_splits(dataset)
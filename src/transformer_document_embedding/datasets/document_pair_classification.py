@@ -41,6 +41,8 @@ KINDS_TO_FILES = {
 
 
 class DocumentPairClassification(DocumentDataset):
+    SPLITS_CACHEABLE = True
+
     def __init__(
         self,
         path: str,
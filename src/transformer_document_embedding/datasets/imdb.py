@@ -11,6 +11,8 @@ from datasets import DatasetDict
 class IMDB(DocumentDataset):
     """Binary classification dataset of IMDB reviews."""
 
+    SPLITS_CACHEABLE = True
+
     def __init__(self, **kwargs) -> None:
         super().__init__(add_ids=True, **kwargs)
         self._path = "imdb"
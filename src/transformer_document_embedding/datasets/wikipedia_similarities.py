@@ -14,6 +14,7 @@ from transformer_document_embedding.datasets.document_dataset import (
 
 class WikipediaSimilarities(DocumentDataset):
     AVAILABLE_DATASETS = ["wine", "game"]
+    SPLITS_CACHEABLE = True
 
     def __init__(
         self,
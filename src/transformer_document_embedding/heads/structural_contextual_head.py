@@ -1,4 +1,5 @@
 from __future__ import annotations
+import logging
 from typing import TYPE_CHECKING, Any
 
 import torch
@@ -11,6 +12,8 @@ if TYPE_CHECKING:
     from transformer_document_embedding.models.embedding_model import EmbeddingModel
     from typing import Optional
 
+logger = logging.getLogger(__name__)
+
 
 class StructuralContextualHead(torch.nn.Module):
     def __init__(
@@ -58,12 +61,18 @@ class StructuralContextualHead(torch.nn.Module):
         soft_cca_lam: Optional[float] = None,
         soft_cca_sdl_alpha: Optional[float] = None,
         max_marginals_lam: Optional[float] = None,
+        compile_projections: bool = False,
+        compile_loss: bool = False,
     ) -> cca_losses.ProjectionLoss:
         student_net = cca_losses.DeepNet(
-            blocks_config=student_projection, input_features=student_dim
+            blocks_config=student_projection,
+            input_features=student_dim,
+            compile_blocks=compile_projections,
         )
         contextual_net = cca_losses.DeepNet(
-            blocks_config=contextual_projection, input_features=contextual_dim
+            blocks_config=contextual_projection,
+            input_features=contextual_dim,
+            compile_blocks=compile_projections,
         )
 
         loss_fn = None
@@ -90,6 +99,14 @@ class StructuralContextualHead(torch.nn.Module):
                 ),
                 lam=soft_cca_lam,
             )
+            if compile_loss:
+                # Fuses the elementwise chain on the running covariance.
+                # `Module.compile` is available only since torch 2.2.
+                if hasattr(loss_fn, "compile"):
+                    loss_fn.sdl1.compile()
+                    loss_fn.sdl2.compile()
+                else:
+                    logger.warning("Cannot compile SDL losses with torch<2.2.")
         else:
             loss_fn = create_sim_based_loss(
                 loss_type, max_marginals_lam=max_marginals_lam
@@ -118,20 +135,19 @@ class StructuralContextualHead(torch.nn.Module):
 
         weighting = self._lam != 0.5
         if weighting:
-            lams = torch.zeros_like(lengths, dtype=torch.float32).fill_(self._lam)
+            lams = torch.full_like(lengths, self._lam, dtype=torch.float32)
 
         if self.structural_head is not None:
             assert (
                 structural_targets is not None
             ), "No targets for structural loss were given."
 
-            mask = (
-                lengths <= self.max_structural_length
-                if self.max_structural_length is not None
-                else torch.ones_like(lengths)
-            )
-            if weighting:
-                lams *= mask
+            # Without a mask the loss doesn't have to select unmasked inputs
+            mask = None
+            if self.max_structural_length is not None:
+                mask = lengths <= self.max_structural_length
+                if weighting:
+                    lams *= mask
 
             structural_outputs = self.structural_head(
                 embeddings, structural_targets, mask=mask
@@ -148,7 +164,9 @@ class StructuralContextualHead(torch.nn.Module):
                     for key, value in structural_outputs.items()
                 }
             )
-            outputs["structural_mask"] = mask
+            outputs["structural_mask"] = (
+                mask if mask is not None else torch.ones_like(lengths)
+            )
 
         if self.contextual_head is not None:
             assert (
@@ -5,6 +5,7 @@ import os
 import numpy as np
 from gensim.models import Doc2Vec
 import torch
+from transformer_document_embedding.datasets import col
 from transformer_document_embedding.models.embedding_model import EmbeddingModel
 from transformer_document_embedding.utils.gensim import (
     create_text_pre_processor,
@@ -15,7 +16,7 @@ import logging
 
 if TYPE_CHECKING:
     from datasets import Dataset
-    from typing import Optional
+    from typing import Optional, Sequence
 
 logger = logging.getLogger(__name__)
 
@@ -25,6 +26,7 @@ class ParagraphVector(Doc2Vec, EmbeddingModel):
         self,
         text_pre_process: Optional[str],
         load_dv: bool,
+        predict_from_dv: bool = False,
         documents=None,
         corpus_file=None,
         vector_size=100,
@@ -70,6 +72,10 @@ class ParagraphVector(Doc2Vec, EmbeddingModel):
         # Whether to load learned paragraph vectors when loading weights
         self.load_dv = load_dv
 
+        # Whether to predict embeddings of documents seen during training by
+        # looking up their learned paragraph vectors instead of inferring them
+        self.predict_from_dv = predict_from_dv
+
     @property
     def embedding_dim(self) -> int:
         return self.vector_size
@@ -78,6 +84,11 @@ class ParagraphVector(Doc2Vec, EmbeddingModel):
     def predict_embeddings(
         self, dataset: Dataset, batch_size: int
     ) -> Iterator[torch.Tensor]:
+        if self.predict_from_dv:
+            for docs in dataset.select_columns(col.ID).iter(batch_size):
+                yield torch.from_numpy(self.get_trained_embeddings(docs[col.ID]))
+            return
+
         pre_processor = create_text_pre_processor(self.text_pre_process)
 
         def add_words(doc: dict[str, Any]) -> dict[str, Any]:
@@ -85,21 +96,46 @@ class ParagraphVector(Doc2Vec, EmbeddingModel):
 
         corpus = dataset.map(add_words, num_proc=self.workers, remove_columns=["text"])
 
-        def to_torch(batch: list[np.ndarray]) -> torch.Tensor:
-            return torch.from_numpy(np.array(batch))
+        def new_batch() -> np.ndarray:
+            # Inferred vectors are written straight into the batch, instead of
+            # being collected and copied together afterwards
+            return np.empty((batch_size, self.vector_size), dtype=np.float32)
 
-        batch = []
+        batch = new_batch()
+        batch_len = 0
         with tqdm(total=len(corpus) // batch_size, desc="Predicting docs") as pb:
             for doc in tqdm(corpus, desc="Predicting docs"):
-                batch.append(self.infer_vector(doc["words"]))
+                batch[batch_len] = self.infer_vector(doc["words"])
+                batch_len += 1
 
-                if len(batch) == batch_size:
-                    yield to_torch(batch)
-                    batch = []
+                if batch_len == batch_size:
+                    yield torch.from_numpy(batch)
+                    batch = new_batch()
+                    batch_len = 0
                     pb.update(1)
 
-        if len(batch) > 0:
-            yield to_torch(batch)
+        if batch_len > 0:
+            yield torch.from_numpy(batch[:batch_len])
+
+    def get_trained_embeddings(self, ids: Sequence[Any]) -> np.ndarray:
+        """Returns learned paragraph vectors of documents seen during training.
+
+        Parameters
+        ----------
+        ids: Sequence[Any]
+            Document tags (`col.ID`) used during training.
+
+        Returns
+        -------
+        np.ndarray
+            Array of shape `(len(ids), embedding_dim)`.
+        """
+        offsets = np.fromiter(
+            (self.dv.get_index(doc_id) for doc_id in ids),
+            dtype=np.int64,
+            count=len(ids),
+        )
+        return self.dv.vectors[offsets]
 
     def save_weights(self, path: str) -> None:
         return self.save(path)
@@ -145,6 +181,12 @@ class ParagraphVectorConcat(EmbeddingModel):
         ):
             yield torch.concat(embeds, dim=1)
 
+    def get_trained_embeddings(self, ids: Sequence[Any]) -> np.ndarray:
+        return np.concatenate(
+            [module.get_trained_embeddings(ids) for module in self.modules.values()],
+            axis=1,
+        )
+
     def save_weights(self, path: str) -> None:
         for name, module in self.modules.items():
             module.save_weights(os.path.join(path, name))
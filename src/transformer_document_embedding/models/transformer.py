@@ -1,7 +1,7 @@
 from __future__ import annotations
 import torch
 import logging
-from typing import TYPE_CHECKING, Iterator
+from typing import TYPE_CHECKING, Iterable, Iterator
 from tqdm.auto import tqdm
 
 from transformers import AutoModel, AutoTokenizer
@@ -89,9 +89,29 @@ class TransformerEmbedder(torch.nn.Module, EmbeddingModel):
             # Normally is not configurable.
             transformer_model_kwargs["add_pooling_layer"] = False
 
-        self.transformer = AutoModel.from_pretrained(
-            transformer_name, **transformer_model_kwargs
-        )
+        if "attn_implementation" in transformer_model_kwargs:
+            self.transformer = AutoModel.from_pretrained(
+                transformer_name, **transformer_model_kwargs
+            )
+        else:
+            try:
+                # PyTorch's fused attention kernels (e.g. FlashAttention)
+                self.transformer = AutoModel.from_pretrained(
+                    transformer_name,
+                    attn_implementation="sdpa",
+                    **transformer_model_kwargs,
+                )
+            except (ValueError, TypeError, ImportError):
+                # Architectures with sparse attention (e.g. Longformer) don't
+                # support SDPA, transformers<4.36 don't accept the argument and
+                # some versions raise ImportError when torch lacks SDPA
+                logger.info(
+                    "SDPA cannot be used with %s, using default attention.",
+                    transformer_name,
+                )
+                self.transformer = AutoModel.from_pretrained(
+                    transformer_name, **transformer_model_kwargs
+                )
         self.pooler = AVAILABLE_POOLERS[pooler_type]()
 
         self.min_sequence_length = None
@@ -179,13 +199,51 @@ class TransformerEmbedder(torch.nn.Module, EmbeddingModel):
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         logger.info(f"Predicting using {device}")
         self.to(device)
-        for batch in tqdm(batches, desc="Predicting batches"):
-            train_utils.batch_to_device(batch, device)
-            yield self(**batch)[col.EMBEDDING]
+        if device.type != "cuda":
+            for batch in tqdm(batches, desc="Predicting batches"):
+                train_utils.batch_to_device(batch, device)
+                yield self(**batch)[col.EMBEDDING]
+        else:
+            yield from self._predict_with_async_copies(batches, device)
 
         # Move the model back to cpu when not in use
         self.to("cpu")
 
+    def _predict_with_async_copies(
+        self, batches: Iterable[dict[str, torch.Tensor]], device: torch.device
+    ) -> Iterator[torch.Tensor]:
+        """Predicts embeddings while copying the previous batch to host.
+
+        Embeddings are copied to pinned memory on a side stream and yielded only
+        after the next batch's forward pass has been queued, so the transfer
+        overlaps with computation.
+        """
+        copy_stream = torch.cuda.Stream(device)
+        pending = None
+        for batch in tqdm(batches, desc="Predicting batches"):
+            train_utils.batch_to_device(batch, device)
+            embeddings = self(**batch)[col.EMBEDDING]
+
+            copy_stream.wait_stream(torch.cuda.current_stream(device))
+            with torch.cuda.stream(copy_stream):
+                host_embeddings = torch.empty(
+                    embeddings.shape, dtype=embeddings.dtype, pin_memory=True
+                )
+                host_embeddings.copy_(embeddings, non_blocking=True)
+                copied = torch.cuda.Event()
+                copied.record(copy_stream)
+            # Don't let the allocator reuse the memory before the copy finishes
+            embeddings.record_stream(copy_stream)
+
+            if pending is not None:
+                pending[1].synchronize()
+                yield pending[0]
+            pending = (host_embeddings, copied)
+
+        if pending is not None:
+            pending[1].synchronize()
+            yield pending[0]
+
     def save_weights(self, filepath: str) -> None:
         save_model_weights(self, filepath)
 
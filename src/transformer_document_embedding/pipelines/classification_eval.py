@@ -7,7 +7,10 @@ from transformer_document_embedding.pipelines.classification_finetune import (
     get_default_features,
     get_pair_bin_cls_features,
 )
-from transformer_document_embedding.pipelines.helpers import classification_metrics
+from transformer_document_embedding.pipelines.helpers import (
+    classification_metrics_from_confusion,
+    confusion_matrix_update,
+)
 
 from transformer_document_embedding.pipelines.pipeline import EvalPipeline
 import torch
@@ -42,7 +45,11 @@ class ClassificationEval(EvalPipeline):
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
         num_classes = len(dataset.splits["test"].unique(col.LABEL))
-        metrics = classification_metrics(num_classes, device=device)
+        # All metrics are derived from the confusion matrix, so only it is
+        # updated per batch
+        confusion = torch.zeros(
+            (num_classes, num_classes), dtype=torch.int64, device=device
+        )
         head.to(device)
 
         for docs in features.with_format("torch").iter(self.batch_size):
@@ -52,10 +59,11 @@ class ClassificationEval(EvalPipeline):
             logits = head(**embeds)["logits"]
             pred_classes = torch.argmax(logits, dim=1)
 
-            for metric in metrics.values():
-                metric.update(pred_classes, docs[col.LABEL].to(device))
+            confusion_matrix_update(
+                confusion, pred_classes, docs[col.LABEL].to(device)
+            )
 
-        return {name: met.compute().item() for name, met in metrics.items()}
+        return classification_metrics_from_confusion(confusion)
 
 
 class PairClassificationEval(ClassificationEval):
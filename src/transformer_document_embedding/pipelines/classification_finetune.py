@@ -92,6 +92,7 @@ class GenericTorchFinetune(TrainPipeline):
 
     warmup_steps: int
     fp16: bool
+    bf16: bool = False
     grad_accumulation_steps: int
     max_grad_norm: float
 
@@ -191,6 +192,7 @@ class GenericTorchFinetune(TrainPipeline):
             train_logger=train_logger,
             val_logger=val_logger,
             fp16=self.fp16,
+            bf16=self.bf16,
             max_grad_norm=self.max_grad_norm,
             grad_accumulation_steps=self.grad_accumulation_steps,
             lr_scheduler=lr_scheduler,
@@ -32,16 +32,20 @@ class PVClassificationHeadTrain(ClassificationFinetune):
         model: ParagraphVector,
         training: bool = True,
     ) -> DataLoader[torch.Tensor]:
-        def get_train_vector(doc: dict[str, Any]) -> np.ndarray:
-            return model.dv[doc[col.ID]]
-
         pre_processor = create_text_pre_processor(model.text_pre_process)
 
         def get_eval_vector(doc: dict[str, Any]) -> np.ndarray:
             return model.infer_vector(pre_processor(doc[col.TEXT]))
 
-        get_embed = get_train_vector if training else get_eval_vector
-        with_embeds = split.map(lambda doc: {col.EMBEDDING: get_embed(doc)})
+        if training:
+            with_embeds = split.map(
+                lambda docs: {
+                    col.EMBEDDING: model.get_trained_embeddings(docs[col.ID])
+                },
+                batched=True,
+            )
+        else:
+            with_embeds = split.map(lambda doc: {col.EMBEDDING: get_eval_vector(doc)})
         with_embeds.set_format("torch")
 
         return DataLoader(
@@ -60,26 +64,37 @@ class PVPairClassificationHeadTrain(ClassificationFinetune):
         model: ParagraphVector,
         training: bool = True,
     ) -> DataLoader[torch.Tensor]:
-        def get_train_vector(id: int, _: str) -> np.ndarray:
-            return model.dv[id]
-
         pre_processor = create_text_pre_processor(model.text_pre_process)
 
-        def get_eval_vector(_: int, text: str) -> np.ndarray:
+        def get_eval_vector(text: str) -> np.ndarray:
             return model.infer_vector(pre_processor(text))
 
-        get_single_embed = get_train_vector if training else get_eval_vector
-
-        def get_embed(doc: dict[str, Any]) -> np.ndarray:
-            return np.concatenate(
-                (
-                    get_single_embed(doc[col.ID_0], doc[col.TEXT_0]),
-                    get_single_embed(doc[col.ID_1], doc[col.TEXT_1]),
-                ),
-                0,
-            )
-
-        with_embeds = split.map(lambda doc: {col.EMBEDDING: get_embed(doc)})
+        def get_train_embeds(docs: dict[str, list[Any]]) -> dict[str, np.ndarray]:
+            return {
+                col.EMBEDDING: np.concatenate(
+                    (
+                        model.get_trained_embeddings(docs[col.ID_0]),
+                        model.get_trained_embeddings(docs[col.ID_1]),
+                    ),
+                    axis=1,
+                )
+            }
+
+        def get_eval_embed(doc: dict[str, Any]) -> dict[str, np.ndarray]:
+            return {
+                col.EMBEDDING: np.concatenate(
+                    (
+                        get_eval_vector(doc[col.TEXT_0]),
+                        get_eval_vector(doc[col.TEXT_1]),
+                    ),
+                    0,
+                )
+            }
+
+        if training:
+            with_embeds = split.map(get_train_embeds, batched=True)
+        else:
+            with_embeds = split.map(get_eval_embed)
         with_embeds.set_format("torch")
 
         return DataLoader(
@@ -1,4 +1,7 @@
 from __future__ import annotations
+from concurrent.futures import Future, ThreadPoolExecutor
+import copy
+import tempfile
 from typing import TYPE_CHECKING, Any, Iterator, cast
 
 from datasets import Dataset, concatenate_datasets
@@ -22,7 +25,13 @@ if TYPE_CHECKING:
 
 
 class CheckpointSave(CallbackAny2Vec):
-    """Callback to periodically save the model."""
+    """Callback to periodically save the model.
+
+    Checkpoints are written from a background thread, so that training can
+    continue while the model is being saved. Each checkpoint is a snapshot of
+    the model taken at the end of the given epoch. At most one save is pending
+    at a time, so there is never more than one snapshot in memory.
+    """
 
     def __init__(
         self,
@@ -30,20 +39,59 @@ class CheckpointSave(CallbackAny2Vec):
         save_dir: str,
         paragraph_vector: ParagraphVector,
     ) -> None:
-        self._epoch_checkpoints = epoch_checkpoints
-        self._save_dir = save_dir
+        self._checkpoint_paths = {
+            epoch: os.path.join(save_dir, f"after_epoch_{epoch}")
+            for epoch in epoch_checkpoints
+        }
         self._epoch = 0
         self._pv = paragraph_vector
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending_save: Optional[Future] = None
+
+        os.makedirs(save_dir, exist_ok=True)
 
-        os.makedirs(self._save_dir, exist_ok=True)
+    def __getstate__(self) -> dict[str, Any]:
+        # The callback gets pickled together with the model
+        state = self.__dict__.copy()
+        del state["_executor"]
+        del state["_pending_save"]
+        return state
 
     def on_epoch_end(self, _) -> None:
-        if self._epoch in self._epoch_checkpoints:
-            model_path = os.path.join(self._save_dir, f"after_epoch_{self._epoch}")
-            self._pv.save_weights(model_path)
+        model_path = self._checkpoint_paths.get(self._epoch, None)
+        if model_path is not None:
+            # At most one pending save, which bounds the memory of snapshots
+            self.wait_for_save()
+
+            # Gensim starts the next epoch as soon as this callback returns and
+            # updates the vectors in place. Saving the model itself in the
+            # background would therefore mix weights of several epochs. Copying
+            # costs less than blocking training for the whole save. Callbacks
+            # (with the training corpus) are left out of the copy.
+            callbacks = getattr(self._pv, "callbacks", ())
+            snapshot = copy.deepcopy(self._pv, memo={id(callbacks): ()})
+            self._pending_save = self._executor.submit(
+                snapshot.save_weights, model_path
+            )
 
         self._epoch += 1
 
+    def wait_for_save(self) -> None:
+        """Blocks until the last checkpoint is written."""
+        if self._pending_save is not None:
+            self._pending_save.result()
+            self._pending_save = None
+
+
+class ReshuffleCorpus(CallbackAny2Vec):
+    """Callback to iterate the corpus in different order each epoch."""
+
+    def __init__(self, corpus: GensimCorpus) -> None:
+        self._corpus = corpus
+
+    def on_epoch_begin(self, _) -> None:
+        self._corpus.reshuffle()
+
 
 def compute_alpha(
     total_epochs: int,
@@ -59,12 +107,29 @@ def compute_alpha(
 
 class TrainPVPipeline(TrainPipeline):
     def __init__(
-        self, start_at_epoch: Optional[int], save_at_epochs: Optional[list[int]]
+        self,
+        start_at_epoch: Optional[int],
+        save_at_epochs: Optional[list[int]],
+        use_corpus_file: bool = False,
     ) -> None:
+        """
+        Parameters:
+        - use_corpus_file: bool
+            Whether to train from a text file instead of iterating the corpus
+            in Python. Scales much better with number of workers, but the
+            corpus is shuffled only once, gensim truncates documents to
+            10000 words and checkpoints tag documents by their line numbers.
+        """
         super().__init__()
 
+        assert start_at_epoch is None or not use_corpus_file, (
+            "Resuming training from a corpus file is not supported, as the order "
+            "of documents would not match the learned paragraph vectors."
+        )
+
         self._start_at_epoch = start_at_epoch
         self._save_at_epochs = save_at_epochs
+        self._use_corpus_file = use_corpus_file
 
         if self._start_at_epoch is not None and self._save_at_epochs is not None:
             self._save_at_epochs = [
@@ -78,6 +143,7 @@ class TrainPVPipeline(TrainPipeline):
             dataset,
             text_pre_processor=create_text_pre_processor(model.text_pre_process),
             num_proc=model.workers,
+            shuffle=True,
         )
 
     def __call__(
@@ -93,22 +159,20 @@ class TrainPVPipeline(TrainPipeline):
             if split_name not in ["test", "validation"]
         ]
 
-        train_data = self.to_gensim_corpus(
-            concatenate_datasets(all_splits).shuffle(), model
-        )
-        callbacks = []
+        # Shuffling is left to the corpus, which does it without copying the data
+        train_data = self.to_gensim_corpus(concatenate_datasets(all_splits), model)
+        callbacks: list[CallbackAny2Vec] = []
+        if not self._use_corpus_file:
+            callbacks.append(ReshuffleCorpus(train_data))
 
+        checkpoint_save = None
         if log_dir is not None and self._save_at_epochs is not None:
-            callbacks.append(
-                CheckpointSave(
-                    epoch_checkpoints=self._save_at_epochs,
-                    save_dir=os.path.join(log_dir, "checkpoints"),
-                    paragraph_vector=model,
-                )
+            checkpoint_save = CheckpointSave(
+                epoch_checkpoints=self._save_at_epochs,
+                save_dir=os.path.join(log_dir, "checkpoints"),
+                paragraph_vector=model,
             )
-
-        if self._start_at_epoch is None:
-            model.build_vocab(train_data)
+            callbacks.append(checkpoint_save)
 
         train_kwargs: dict[str, Any] = {
             "epochs": model.epochs,
@@ -125,11 +189,47 @@ class TrainPVPipeline(TrainPipeline):
             train_kwargs["end_alpha"] = 1e-4
             train_kwargs["epochs"] -= self._start_at_epoch
 
-        model.train(
-            train_data,
-            total_examples=model.corpus_count,
-            **train_kwargs,
-        )
+        if self._use_corpus_file:
+            self._train_from_corpus_file(model, train_data, train_kwargs)
+        else:
+            if self._start_at_epoch is None:
+                model.build_vocab(train_data)
+
+            model.train(
+                train_data,
+                total_examples=model.corpus_count,
+                **train_kwargs,
+            )
+
+        if checkpoint_save is not None:
+            checkpoint_save.wait_for_save()
+
+    def _train_from_corpus_file(
+        self,
+        model: ParagraphVector,
+        train_data: GensimCorpus,
+        train_kwargs: dict[str, Any],
+    ) -> None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            corpus_file = os.path.join(tmp_dir, "corpus.txt")
+
+            tags = []
+            with open(corpus_file, mode="w", encoding="utf8") as file:
+                for doc in train_data:
+                    file.write(" ".join(doc.words) + "\n")
+                    tags.append(doc.tags[0])
+
+            model.build_vocab(corpus_file=corpus_file)
+            model.train(
+                corpus_file=corpus_file,
+                total_examples=model.corpus_count,
+                total_words=model.corpus_total_words,
+                **train_kwargs,
+            )
+
+        # In corpus file mode documents are tagged by their line numbers
+        model.dv.index_to_key = tags
+        model.dv.key_to_index = {tag: i for i, tag in enumerate(tags)}
 
 
 class PairedGensimCorpus(GensimCorpus):
@@ -142,6 +242,8 @@ class PairedGensimCorpus(GensimCorpus):
         dataset: Dataset,
         text_pre_processor: TextPreProcessor,
         num_proc: int = 0,
+        shuffle: bool = False,
+        seed: Optional[int] = None,
     ) -> None:
         self._text_preprocessor = text_pre_processor
         self._dataset = Dataset.from_generator(
@@ -149,6 +251,7 @@ class PairedGensimCorpus(GensimCorpus):
             gen_kwargs={"pairs_dataset": dataset},
             num_proc=num_proc,
         )
+        self._init_order(shuffle, seed)
 
     def _unique_gensim_docs_iter(
         self, pairs_dataset: Dataset
@@ -183,4 +286,5 @@ class TrainPairPVPipeline(TrainPVPipeline):
             dataset,
             text_pre_processor=create_text_pre_processor(model.text_pre_process),
             num_proc=model.workers,
+            shuffle=True,
         )
@@ -1,5 +1,9 @@
 from __future__ import annotations
-from typing import Iterable, Iterator, TYPE_CHECKING
+from queue import Full, Queue
+from threading import Event, Thread
+from typing import Iterable, Iterator, TypeVar
+
+import torch
 
 from torcheval.metrics import (
     BinaryAccuracy,
@@ -12,8 +16,7 @@ from torcheval.metrics import (
     MulticlassPrecision,
 )
 
-if TYPE_CHECKING:
-    import torch
+T = TypeVar("T")
 
 
 def classification_metrics(num_classes: int, **metric_kwargs) -> dict[str, Metric]:
@@ -55,6 +58,55 @@ def classification_metrics(num_classes: int, **metric_kwargs) -> dict[str, Metri
     }
 
 
+def confusion_matrix_update(
+    confusion: torch.Tensor, pred_classes: torch.Tensor, true_classes: torch.Tensor
+) -> None:
+    """Adds counts of (true class, predicted class) pairs to `confusion` in place."""
+    num_classes = confusion.size(0)
+    confusion += torch.bincount(
+        true_classes * num_classes + pred_classes, minlength=num_classes**2
+    ).view(num_classes, num_classes)
+
+
+def classification_metrics_from_confusion(confusion: torch.Tensor) -> dict[str, float]:
+    """Computes the metrics of `classification_metrics` in closed form.
+
+    `confusion[i, j]` is the number of inputs of class `i` predicted as `j`.
+    Undefined precisions and F1 scores count as 0. Like in torcheval, macro
+    accuracy averages over classes with some inputs, macro precision and F1 over
+    classes which are either among the inputs or the predictions.
+    """
+    confusion = confusion.double()
+    true_positives = confusion.diagonal()
+    support = confusion.sum(dim=1)
+    predicted = confusion.sum(dim=0)
+
+    accuracy = true_positives.sum() / confusion.sum()
+    precision = torch.nan_to_num(true_positives / predicted)
+    recall = torch.nan_to_num(true_positives / support)
+    f1 = torch.nan_to_num(2 * true_positives / (support + predicted))
+
+    if confusion.size(0) == 2:
+        # Class 1 is the positive one
+        metrics = {
+            "binary_precision": precision[1],
+            "binary_accuracy": accuracy,
+            "binary_f1": f1[1],
+            "binary_recall": recall[1],
+        }
+    else:
+        present = support > 0
+        seen = present | (predicted > 0)
+        metrics = {
+            "micro_accuracy": accuracy,
+            "macro_accuracy": recall[present].mean(),
+            "macro_precision": precision[seen].mean(),
+            "macro_f1": f1[seen].mean(),
+        }
+
+    return {name: value.item() for name, value in metrics.items()}
+
+
 def smart_unbatch(
     iterable: Iterable[torch.Tensor],
     single_dim: int,
@@ -64,3 +116,48 @@ def smart_unbatch(
             yield from smart_unbatch(batch, single_dim)
         else:
             yield batch
+
+
+def prefetch(iterable: Iterable[T], buffer_size: int = 1) -> Iterator[T]:
+    """Iterates `iterable` in a background thread.
+
+    At most `buffer_size` items are computed ahead of the consumer. Useful when
+    producing items releases the GIL (e.g. faiss search) and consuming them
+    does not.
+    """
+    queue = Queue(maxsize=buffer_size)
+    end = object()
+    stop = Event()
+
+    def put(entry: tuple) -> bool:
+        # Bounded waits, so that the producer exits once the consumer stops
+        while not stop.is_set():
+            try:
+                queue.put(entry, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def produce() -> None:
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except Exception as exc:
+            put((end, exc))
+        else:
+            put((end, None))
+
+    Thread(target=produce, daemon=True).start()
+
+    try:
+        while True:
+            item, exc = queue.get()
+            if exc is not None:
+                raise exc
+            if item is end:
+                return
+            yield item
+    finally:
+        stop.set()
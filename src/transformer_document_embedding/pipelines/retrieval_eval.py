@@ -1,16 +1,16 @@
 from __future__ import annotations
 from dataclasses import dataclass
-from functools import reduce
-from typing import Any, Iterable, Optional, TYPE_CHECKING, cast
+from typing import Iterable, Optional, TYPE_CHECKING
 import faiss
 import numpy as np
-from sklearn.metrics import average_precision_score, ndcg_score
+import pyarrow.compute as pc
 from tqdm.auto import tqdm
 
 from transformer_document_embedding.datasets import col
 from transformer_document_embedding.pipelines.classification_finetune import (
     get_default_features,
 )
+from transformer_document_embedding.pipelines.helpers import prefetch
 from transformer_document_embedding.pipelines.pipeline import EvalPipeline
 
 
@@ -24,6 +24,51 @@ if TYPE_CHECKING:
 @dataclass(kw_only=True)
 class RetrievalEval(EvalPipeline):
     batch_size: int
+    # Faiss index used for test splits larger than `exact_search_max_size`.
+    # Smaller splits are searched exhaustively. For memory-bound searches
+    # a 4-bit PQ fast-scan index with re-ranking, e.g.
+    # "OPQ16_64,IVF1024,PQ16x4fsr,RFlat" with "nprobe=32", is a good choice.
+    index_factory: str = "HNSW32"
+    index_params: Optional[str] = "efSearch=100"
+    # Size of the candidate list used when building HNSW graphs. Faiss' default
+    # of 40 noticeably lowers recall deep in the returned lists.
+    hnsw_ef_construction: int = 200
+    exact_search_max_size: int = 50_000
+    # Number of randomly sampled embeddings quantizers of the approximate index
+    # are trained on. All embeddings are used if not set.
+    index_train_size: Optional[int] = None
+    # Store vectors of exhaustive search in half precision
+    use_fp16: bool = False
+    # Whether to search on all available GPUs. Falls back to CPU without them.
+    use_gpu: bool = True
+    # Whether repeated evaluations (e.g. of the same model during training)
+    # should reuse the index trained in the first one. Only the vectors are
+    # replaced, quantizers are not re-trained.
+    reuse_trained_index: bool = False
+    # Number of queries searched for at once
+    search_batch_size: int = 1024
+
+    def __post_init__(self) -> None:
+        self._trained_indices: dict[tuple[str, int, bool], faiss.Index] = {}
+
+    def _create_index(self, index_factory: str, dim: int) -> faiss.Index:
+        index = faiss.index_factory(dim, index_factory, faiss.METRIC_INNER_PRODUCT)
+        # Build-time parameters must be set before any vectors are added
+        hnsw_index = faiss.downcast_index(index)
+        if isinstance(hnsw_index, faiss.IndexHNSW):
+            hnsw_index.hnsw.efConstruction = self.hnsw_ef_construction
+
+        return index
+
+    def _sample_train_embeddings(self, embeddings: np.ndarray) -> np.ndarray:
+        if self.index_train_size is None or self.index_train_size >= len(embeddings):
+            return embeddings
+
+        # Random sample, since datasets are often ordered by labels or sources
+        train_inds = np.random.default_rng().choice(
+            len(embeddings), self.index_train_size, replace=False
+        )
+        return embeddings[np.sort(train_inds)]
 
     def _get_nearest_ids_from_faiss(
         self,
@@ -31,38 +76,144 @@ class RetrievalEval(EvalPipeline):
         *,
         k: Optional[int] = None,
     ) -> Iterable[tuple[list[int], list[int]]]:
-        def norm_embeddings(docs: dict[str, np.ndarray]) -> dict[str, np.ndarray]:
-            embeds = docs[col.EMBEDDING]
-            normed = embeds / np.linalg.norm(embeds, axis=1).reshape(-1, 1)
-            return {col.EMBEDDING: normed}
-
-        faiss_dataset = dataset.with_format("numpy").map(
-            norm_embeddings, batched=True, batch_size=256
+        # One contiguous float32 matrix is what faiss works with natively
+        embeddings = np.ascontiguousarray(
+            dataset.with_format("numpy")[col.EMBEDDING], dtype=np.float32
         )
-        faiss_dataset.add_faiss_index(
-            col.EMBEDDING, metric_type=faiss.METRIC_INNER_PRODUCT
+        # In place and leaves zero vectors untouched instead of dividing by zero
+        faiss.normalize_L2(embeddings)
+
+        approximate = len(embeddings) > self.exact_search_max_size
+        exact_index_factory = "SQfp16" if self.use_fp16 else "Flat"
+        index_factory = self.index_factory if approximate else exact_index_factory
+        # Faiss implements only some indices on GPUs (e.g. not HNSW, SQ or PQ
+        # fast-scan ones), so only exhaustive float32 search is moved there
+        on_gpu = self.use_gpu and faiss.get_num_gpus() > 0 and index_factory == "Flat"
+
+        index_key = (index_factory, embeddings.shape[1], on_gpu)
+        trained_index = self._trained_indices.get(index_key, None)
+        if self.reuse_trained_index and trained_index is not None:
+            trained_index.reset()
+            index_kwargs = {"custom_index": trained_index}
+        elif on_gpu:
+            index_kwargs = {"string_factory": index_factory, "device": -1}
+        else:
+            index = self._create_index(index_factory, embeddings.shape[1])
+            if not index.is_trained:
+                index.train(self._sample_train_embeddings(embeddings))
+            index_kwargs = {"custom_index": index}
+
+        faiss_dataset = dataset.remove_columns(col.EMBEDDING)
+        faiss_dataset.add_faiss_index_from_external_arrays(
+            embeddings,
+            index_name=col.EMBEDDING,
+            metric_type=faiss.METRIC_INNER_PRODUCT,
+            **index_kwargs,
         )
+        if self.reuse_trained_index:
+            self._trained_indices[index_key] = faiss_dataset.get_index(
+                col.EMBEDDING
+            ).faiss_index
+
+        faiss_index = faiss_dataset.get_index(col.EMBEDDING).faiss_index
+        if approximate and self.index_params is not None:
+            faiss.ParameterSpace().set_index_parameters(faiss_index, self.index_params)
 
         if k is None:
             k = len(faiss_dataset)
 
-        for article in faiss_dataset:
-            article = cast(dict[str, Any], article)
+        # Looking ids up in an array avoids fetching whole nearest examples
+        ids = np.asarray(faiss_dataset[col.ID])
+        # Labels are read as Arrow lists so that ids of target articles can be
+        # extracted without building a dict for each of them
+        labels = faiss_dataset.select_columns(col.LABEL).with_format("arrow")
 
-            if len(article[col.LABEL]) == 0:
+        for start in range(0, len(labels), self.search_batch_size):
+            batch_labels = labels[start : start + self.search_batch_size][
+                col.LABEL
+            ].combine_chunks()
+            label_counts = pc.list_value_length(batch_labels).to_numpy(
+                zero_copy_only=False
+            )
+            query_inds = start + np.flatnonzero(label_counts)
+            if len(query_inds) == 0:
                 continue
 
-            nearest_targets = faiss_dataset.get_nearest_examples(
-                col.EMBEDDING,
-                np.array(article[col.EMBEDDING]),
-                k=k
-                + 1,  # We're later removing the first hit, which is the query itself.
+            targets = pc.list_flatten(batch_labels)
+            target_ids = targets.flatten()[targets.type.get_field_index(col.ID)]
+            batch_true_ids = np.split(
+                target_ids.to_numpy(zero_copy_only=False),
+                np.cumsum(label_counts)[:-1],
             )
 
-            true_ids = [target_article[col.ID] for target_article in article[col.LABEL]]
-            pred_ids = nearest_targets.examples[col.ID][1:]
+            # One search call per batch of queries lets faiss use its batched
+            # distance computations. We're later removing the first hit, which
+            # is the query itself.
+            _, batch_nearest_indices = faiss_index.search(embeddings[query_inds], k + 1)
+
+            for query_ind, nearest_indices in zip(
+                query_inds, batch_nearest_indices, strict=True
+            ):
+                # Approximate indices may return less than `k` results
+                nearest_indices = nearest_indices[nearest_indices >= 0]
+
+                true_ids = batch_true_ids[query_ind - start]
+                pred_ids = ids[nearest_indices[1:]]
+
+                yield true_ids, pred_ids
 
-            yield true_ids, pred_ids
+    @staticmethod
+    def _sum_ir_metrics(
+        hit_rows: list[np.ndarray],
+        num_true: list[int],
+        hits_thresholds: np.ndarray,
+    ) -> dict[str, np.ndarray]:
+        """Sums IR metrics over a chunk of queries.
+
+        Hits of all queries are put into a single dense matrix, padded with
+        misses, so that every metric is computed with a few column-wise ops.
+        """
+        max_ranks = np.array([len(row) for row in hit_rows])
+        hits = np.zeros((len(hit_rows), max_ranks.max()), dtype=bool)
+        for row_ind, row in enumerate(hit_rows):
+            hits[row_ind, : len(row)] = row
+
+        num_true = np.array(num_true)
+        ranks = np.arange(1, hits.shape[1] + 1)
+        # Number of correct predictions up to each rank
+        cum_hits = np.cumsum(hits, axis=1)
+        num_hits = cum_hits[:, -1]
+        has_hits = num_hits > 0
+
+        # Predictions are strictly ordered, so precision at each hit and
+        # discounted gains can be computed directly from hits' ranks. Queries
+        # without hits score 0.
+        average_precisions = np.sum(hits * cum_hits / ranks, axis=1) / np.maximum(
+            num_hits, 1
+        )
+        discounts = 1 / np.log2(ranks + 1)
+        ideal_dcgs = np.concatenate(([1.0], np.cumsum(discounts)))[num_hits]
+        ndcgs = np.sum(hits * discounts, axis=1) / ideal_dcgs
+
+        # The best-ranking correct prediction index
+        first_hit_inds = np.where(has_hits, np.argmax(hits, axis=1) + 1, max_ranks)
+
+        # So that MPR is between 0 and 1
+        percentile_ranks = hits * (ranks - 1) / (max_ranks[:, None] - 1)
+
+        # Number of correct predictions under each threshold
+        threshold_inds = np.minimum(hits_thresholds, hits.shape[1]) - 1
+        hit_percentages = cum_hits[:, threshold_inds] / num_true[:, None]
+
+        return {
+            "queries": np.array(len(hit_rows)),
+            "hits": num_hits.sum(),
+            "reciprocal_rank": np.sum(1 / first_hit_inds),
+            "percentile_rank": percentile_ranks.sum(),
+            "average_precision": average_precisions.sum(),
+            "ndcg": ndcgs.sum(),
+            "hit_percentages": hit_percentages.sum(axis=0),
+        }
 
     def _evaluate_ir_metrics(
         self,
@@ -73,14 +224,16 @@ class RetrievalEval(EvalPipeline):
         verbose: bool = False,
     ) -> dict[str, float]:
         hits_thresholds = np.array(hits_thresholds, dtype=np.int32)
-        hit_percentages = [[] for _ in hits_thresholds]
-        reciprocal_rank = 0
-        percentile_ranks = []
-
-        average_precisions = []
-        ndcgs = []
+        totals = {}
+        hit_rows = []
+        num_true = []
 
-        total_queries = 0
+        def add_chunk() -> None:
+            chunk_sums = self._sum_ir_metrics(hit_rows, num_true, hits_thresholds)
+            for name, value in chunk_sums.items():
+                totals[name] = totals.get(name, 0) + value
+            hit_rows.clear()
+            num_true.clear()
 
         for true_ids, pred_ids in tqdm(
             true_pred_ids_iterable,
@@ -91,56 +244,32 @@ class RetrievalEval(EvalPipeline):
             # We assume we go over queries with some true positives
             assert len(true_ids) > 0
 
-            max_rank = len(pred_ids)
-            first_hit_ind = max_rank
-            query_hits = np.zeros(len(hits_thresholds))
-
-            bin_true = np.isin(pred_ids, true_ids)
-            # generate artificial scores, since only the order matters
-            pred_score = np.linspace(1, 0, len(pred_ids))
-            average_precisions.append(average_precision_score(bin_true, pred_score))
-            ndcgs.append(
-                ndcg_score(
-                    bin_true.reshape((1, -1)),
-                    pred_score.reshape((1, -1)),
-                    ignore_ties=True,
-                )
-            )
-
-            # For all predictions
-            for i, pred_id in enumerate(pred_ids, start=1):
-                # Skip those which are incorrect
-                if pred_id not in true_ids:
-                    continue
+            hit_rows.append(np.isin(pred_ids, true_ids))
+            num_true.append(len(true_ids))
+            if len(hit_rows) == self.search_batch_size:
+                add_chunk()
 
-                # Save the best-ranking correct prediction index
-                if first_hit_ind > i:
-                    first_hit_ind = i
-
-                # So that MPR is between 0 and 1
-                percentile_ranks.append((i - 1) / (max_rank - 1))
-                # For every correct prediction under a threshold we add 1
-                query_hits += (i <= hits_thresholds).astype("int32")
-
-            reciprocal_rank += 1 / first_hit_ind
-            total_queries += 1
-
-            for perctanges, num_of_hits in zip(
-                hit_percentages, query_hits, strict=True
-            ):
-                perctanges.append(num_of_hits / len(true_ids))
+        if len(hit_rows) > 0:
+            add_chunk()
 
+        total_queries = totals["queries"]
+        total_hits = totals["hits"]
         results = {
-            "mean_reciprocal_rank": reciprocal_rank / total_queries,
-            "mean_percentile_rank": np.mean(percentile_ranks).item(),
-            "map": np.mean(average_precisions).item(),
-            "ndcg": np.mean(ndcgs).item(),
+            "mean_reciprocal_rank": (totals["reciprocal_rank"] / total_queries).item(),
+            "mean_percentile_rank": (
+                (totals["percentile_rank"] / total_hits).item()
+                if total_hits > 0
+                else float("nan")
+            ),
+            "map": (totals["average_precision"] / total_queries).item(),
+            "ndcg": (totals["ndcg"] / total_queries).item(),
         }
 
-        for percentages, threshold in zip(
-            hit_percentages, hits_thresholds, strict=True
+        mean_hit_percentages = totals["hit_percentages"] / total_queries
+        for percentage, threshold in zip(
+            mean_hit_percentages, hits_thresholds, strict=True
         ):
-            results[f"hit_rate_at_{threshold}"] = np.mean(percentages).item()
+            results[f"hit_rate_at_{threshold}"] = percentage.item()
 
         return results
 
@@ -155,16 +284,16 @@ class RetrievalEval(EvalPipeline):
             test_split, model, batch_size=self.batch_size
         )
 
-        true_pred_ids_iter = self._get_nearest_ids_from_faiss(
-            with_embeds,
-            k=1000,
+        # Search for the next query while metrics of the current one are computed
+        true_pred_ids_iter = prefetch(
+            self._get_nearest_ids_from_faiss(with_embeds, k=1000), buffer_size=8
         )
 
-        test_sims_total = reduce(
-            lambda acc, doc: acc + int(len(doc[col.LABEL]) > 0),
-            test_split,
-            0,
+        # Counting label lengths in Arrow avoids decoding every document
+        label_lengths = pc.list_value_length(
+            test_split.with_format("arrow")[col.LABEL]
         )
+        test_sims_total = np.count_nonzero(label_lengths.to_numpy())
 
         return self._evaluate_ir_metrics(
             true_pred_ids_iter,
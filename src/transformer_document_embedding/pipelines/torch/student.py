@@ -13,7 +13,7 @@ from transformer_document_embedding.utils.metrics import (
     TrainingMetric,
     WindowedAbsCorrelationMetric,
     WindowedAbsCrossCorrelationMetric,
-    WindowedCCAMetricZoo,
+    WindowedCCAMetric,
 )
 from typing import TYPE_CHECKING, Optional
 
@@ -30,18 +30,19 @@ if TYPE_CHECKING:
     )
 
 
-def log_max_abs_grad(
-    metric: Metric,
-    *_,
-    param_name: str,
-    model: torch.nn.Module,
-) -> None:
-    param = model.get_parameter(param_name)
+def log_max_abs_grad(metric: Metric, *_, param: torch.nn.Parameter) -> None:
     grad = param.grad
     if grad is None:
         metric.update(torch.tensor([torch.nan], device=param.device))
     else:
-        metric.update(grad.abs().max())
+        # Single fused reduction, without materializing `grad.abs()`
+        metric.update(torch.linalg.vector_norm(grad.detach(), ord=float("inf")))
+
+
+def update_with_output(
+    metric: Metric, outputs: dict[str, torch.Tensor], *_, key: str
+) -> None:
+    metric.update(outputs[key])
 
 
 class _Student(torch.nn.Module):
@@ -150,68 +151,36 @@ class StudentTrainPipeline(TorchTrainPipeline):
 
     def get_loss_metrics(self, log_freq: int, model: _Student) -> list[TrainingMetric]:
         """Metrics logging parts of loss."""
+
+        def output_mean(name: str, output_key: str) -> TrainingMetric:
+            return TrainingMetric(
+                name, Mean(), log_freq, partial(update_with_output, key=output_key)
+            )
+
         loss_metrics = []
 
         if model.head.contextual_head is not None:
-            loss_metrics.append(
-                TrainingMetric(
-                    "mean_contextual_loss",
-                    Mean(),
-                    log_freq,
-                    lambda metric, outputs, _: metric.update(
-                        outputs["contextual_loss"]
-                    ),
-                )
-            )
+            loss_metrics.append(output_mean("mean_contextual_loss", "contextual_loss"))
 
             if isinstance(model.head.contextual_head.loss_fn, cca_losses.SoftCCALoss):
                 loss_metrics.extend(
                     [
-                        TrainingMetric(
-                            "mean_projection_l2_norm",
-                            Mean(),
-                            log_freq,
-                            lambda metric, outputs, _: metric.update(
-                                outputs["contextual_l2"]
-                            ),
-                        ),
-                        TrainingMetric(
-                            "mean_projection_sdl1",
-                            Mean(),
-                            log_freq,
-                            lambda metric, outputs, _: metric.update(
-                                outputs["contextual_sdl1"]
-                            ),
-                        ),
-                        TrainingMetric(
-                            "mean_projection_sdl2",
-                            Mean(),
-                            log_freq,
-                            lambda metric, outputs, _: metric.update(
-                                outputs["contextual_sdl2"]
-                            ),
-                        ),
+                        output_mean("mean_projection_l2_norm", "contextual_l2"),
+                        output_mean("mean_projection_sdl1", "contextual_sdl1"),
+                        output_mean("mean_projection_sdl2", "contextual_sdl2"),
                     ]
                 )
 
             if isinstance(model.head.contextual_head.loss_fn, MaxMarginalsLoss):
                 loss_metrics.extend(
                     [
-                        TrainingMetric(
+                        output_mean(
+                            "contextual_marginals_positive",
                             "contextual_marginals_positive",
-                            Mean(),
-                            log_freq,
-                            lambda metric, outputs, _: metric.update(
-                                outputs["contextual_marginals_positive"]
-                            ),
                         ),
-                        TrainingMetric(
+                        output_mean(
+                            "contextual_marginals_negative",
                             "contextual_marginals_negative",
-                            Mean(),
-                            log_freq,
-                            lambda metric, outputs, _: metric.update(
-                                outputs["contextual_marginals_negative"]
-                            ),
                         ),
                     ]
                 )
@@ -219,22 +188,8 @@ class StudentTrainPipeline(TorchTrainPipeline):
         if model.head.structural_head is not None:
             loss_metrics.extend(
                 [
-                    TrainingMetric(
-                        "mean_structural_loss",
-                        Mean(),
-                        log_freq,
-                        lambda metric, outputs, _: metric.update(
-                            outputs["structural_loss"]
-                        ),
-                    ),
-                    TrainingMetric(
-                        "mean_structural_mask",
-                        Mean(),
-                        log_freq,
-                        lambda metric, outputs, _: metric.update(
-                            outputs["structural_mask"]
-                        ),
-                    ),
+                    output_mean("mean_structural_loss", "structural_loss"),
+                    output_mean("mean_structural_mask", "structural_mask"),
                     TrainingMetric(
                         "structural_steps",
                         Sum(),
@@ -250,21 +205,13 @@ class StudentTrainPipeline(TorchTrainPipeline):
         if isinstance(model.head.structural_head, MaxMarginalsLoss):
             loss_metrics.extend(
                 [
-                    TrainingMetric(
+                    output_mean(
+                        "structural_marginals_positive",
                         "structural_marginals_positive",
-                        Mean(),
-                        log_freq,
-                        lambda metric, outputs, _: metric.update(
-                            outputs["structural_marginals_positive"]
-                        ),
                     ),
-                    TrainingMetric(
+                    output_mean(
+                        "structural_marginals_negative",
                         "structural_marginals_negative",
-                        Mean(),
-                        log_freq,
-                        lambda metric, outputs, _: metric.update(
-                            outputs["structural_marginals_negative"]
-                        ),
                     ),
                 ]
             )
@@ -279,19 +226,26 @@ class StudentTrainPipeline(TorchTrainPipeline):
 
         projection_metrics = []
 
+        # Windowed metrics are expensive, so nothing is accumulated for batches
+        # without projections
         def update_with_projection(
             metric, outputs, _, *, net1_layer_ind: int, net2_layer_ind: int
         ) -> None:
-            metric.update(
-                outputs["contextual_projected_views1"][net1_layer_ind],
-                outputs["contextual_projected_views2"][net2_layer_ind],
-            )
+            views1 = outputs.get("contextual_projected_views1", None)
+            views2 = outputs.get("contextual_projected_views2", None)
+            if views1 is None or views2 is None:
+                return
+            metric.update(views1[net1_layer_ind], views2[net2_layer_ind])
 
         def update_with_projection1(metric, outputs, _, layer_ind):
-            metric.update(outputs["contextual_projected_views1"][layer_ind])
+            views = outputs.get("contextual_projected_views1", None)
+            if views is not None:
+                metric.update(views[layer_ind])
 
         def update_with_projection2(metric, outputs, _, layer_ind):
-            metric.update(outputs["contextual_projected_views2"][layer_ind])
+            views = outputs.get("contextual_projected_views2", None)
+            if views is not None:
+                metric.update(views[layer_ind])
 
         net1_feats = model.head.contextual_head.net1.features
         net2_feats = model.head.contextual_head.net2.features
@@ -307,6 +261,9 @@ class StudentTrainPipeline(TorchTrainPipeline):
         def win_shift(window_size: int) -> int:
             return to_int(window_size * self.metric_window_shift_frac)
 
+        # The shorter net's first layer is paired with several layers of the
+        # longer one, its correlation metric is created just once
+        net1_corr_layers, net2_corr_layers = set(), set()
         for net1_layer_ind, net2_layer_ind in reverse_projcetion_layers():
             min_dim = min(net1_feats[net1_layer_ind], net2_feats[net2_layer_ind])
 
@@ -324,10 +281,11 @@ class StudentTrainPipeline(TorchTrainPipeline):
                 self.metric_window_size_mult * 2,
             ]:
                 window_size = to_int(min_dim * multiplier)
-                cca_metric = WindowedCCAMetricZoo(
+                cca_metric = WindowedCCAMetric(
                     n_components=min_dim,
                     window_size=window_size,
                     window_shift=win_shift(window_size),
+                    average=True,
                 )
 
                 metric_name = (
@@ -358,47 +316,53 @@ class StudentTrainPipeline(TorchTrainPipeline):
                     reset_after_log=False,
                 )
             )
-            net1_window = to_int(
-                net1_feats[net1_layer_ind] * self.metric_window_size_mult
-            )
-            net1_win_shift = win_shift(net1_window)
-            projection_metrics.append(
-                TrainingMetric(
-                    f"corr_student_projection[{net1_layer_ind}]_x{net1_window}",
-                    WindowedAbsCorrelationMetric(net1_window, net1_win_shift),
-                    net1_win_shift,
-                    view1_update_fn,
-                    reset_after_log=False,
+            if net1_layer_ind not in net1_corr_layers:
+                net1_corr_layers.add(net1_layer_ind)
+                net1_window = to_int(
+                    net1_feats[net1_layer_ind] * self.metric_window_size_mult
+                )
+                net1_win_shift = win_shift(net1_window)
+                projection_metrics.append(
+                    TrainingMetric(
+                        f"corr_student_projection[{net1_layer_ind}]_x{net1_window}",
+                        WindowedAbsCorrelationMetric(net1_window, net1_win_shift),
+                        net1_win_shift,
+                        view1_update_fn,
+                        reset_after_log=False,
+                    )
                 )
-            )
 
-            net2_window = to_int(
-                net2_feats[net2_layer_ind] * self.metric_window_size_mult
-            )
-            net2_win_shift = win_shift(net2_window)
-            projection_metrics.append(
-                TrainingMetric(
-                    f"corr_contextual_projection[{net2_layer_ind}]_x{net2_window}",
-                    WindowedAbsCorrelationMetric(net2_window, net2_win_shift),
-                    net2_win_shift,
-                    view2_update_fn,
-                    reset_after_log=False,
+            if net2_layer_ind not in net2_corr_layers:
+                net2_corr_layers.add(net2_layer_ind)
+                net2_window = to_int(
+                    net2_feats[net2_layer_ind] * self.metric_window_size_mult
+                )
+                net2_win_shift = win_shift(net2_window)
+                projection_metrics.append(
+                    TrainingMetric(
+                        f"corr_contextual_projection[{net2_layer_ind}]"
+                        f"_x{net2_window}",
+                        WindowedAbsCorrelationMetric(net2_window, net2_win_shift),
+                        net2_win_shift,
+                        view2_update_fn,
+                        reset_after_log=False,
+                    )
                 )
-            )
 
         return projection_metrics
 
     def get_grad_metrics(self, log_freq: int, model: _Student) -> list[TrainingMetric]:
+        # Parameters are looked up once, not on every update
+        last_layer_ind = model.encoder.transformer.config.num_hidden_layers - 1
+        student_param = model.get_parameter(
+            f"encoder.transformer.encoder.layer.{last_layer_ind}.output.dense.weight"
+        )
         grad_metrics = [
             TrainingMetric(
                 "max_abs_student_grad",
                 Max(),
                 log_freq,
-                partial(
-                    log_max_abs_grad,
-                    param_name="encoder.transformer.encoder.layer.11.output.dense.weight",
-                    model=model,
-                ),
+                partial(log_max_abs_grad, param=student_param),
             ),
         ]
 
@@ -420,8 +384,7 @@ class StudentTrainPipeline(TorchTrainPipeline):
                         log_freq,
                         partial(
                             log_max_abs_grad,
-                            param_name=sample_projection_weight_path,
-                            model=model,
+                            param=model.get_parameter(sample_projection_weight_path),
                         ),
                     )
                 )
@@ -1,8 +1,10 @@
 from __future__ import annotations
 from dataclasses import dataclass
+import os
 from os import path
 from typing import Any, Callable, Optional, TYPE_CHECKING
 import torch
+from torch.nn.parallel import DistributedDataParallel
 from transformers import AutoTokenizer
 from transformer_document_embedding.torch_trainer import MetricLogger, TorchTrainer
 
@@ -37,6 +39,7 @@ class TorchTrainPipeline(TrainPipeline):
 
     warmup_steps: int
     fp16: bool
+    bf16: bool = False
     grad_accumulation_steps: int
     max_grad_norm: float
 
@@ -131,6 +134,13 @@ class TorchTrainPipeline(TrainPipeline):
         dataset: DocumentDataset,
         log_dir: Optional[str],
     ) -> None:
+        distributed = (
+            torch.distributed.is_available() and torch.distributed.is_initialized()
+        )
+        if distributed and torch.distributed.get_rank() != 0:
+            # Only the first process logs and saves checkpoints
+            log_dir = None
+
         save_model_callback = self.get_save_model_callback(
             self.save_best or (self.save_after_steps is not None),
             encoder,
@@ -160,18 +170,42 @@ class TorchTrainPipeline(TrainPipeline):
         )
 
         if encoder.transformer.supports_gradient_checkpointing:
-            encoder.transformer.gradient_checkpointing_enable()
+            # Non-reentrant checkpointing works with torch.compile and with
+            # DDP's no_sync
+            try:
+                encoder.transformer.gradient_checkpointing_enable(
+                    gradient_checkpointing_kwargs={"use_reentrant": False}
+                )
+            except TypeError:
+                # transformers<4.35 doesn't accept checkpointing kwargs
+                encoder.transformer.gradient_checkpointing_enable()
 
         train_logger, val_logger = self.get_train_val_loggers(
             log_dir, self.get_train_metrics(self.log_every_step, model)
         )
 
+        device = None
+        trained_model = model
+        if distributed:
+            local_rank = int(os.environ["LOCAL_RANK"])
+            device = torch.device("cuda", local_rank)
+            trained_model = DistributedDataParallel(
+                model.to(device),
+                device_ids=[local_rank],
+                gradient_as_bucket_view=True,
+                # Heads may leave a loss branch inactive (e.g. with `lam` set to
+                # 0 or 1), whose parameters then get no gradients
+                find_unused_parameters=True,
+            )
+
         trainer = TorchTrainer(
-            model=model,
+            model=trained_model,
+            device=device,
             optimizer=optimizer,
             train_logger=train_logger,
             val_logger=val_logger,
             fp16=self.fp16,
+            bf16=self.bf16,
             max_grad_norm=self.max_grad_norm,
             grad_accumulation_steps=self.grad_accumulation_steps,
             lr_scheduler=lr_scheduler,
@@ -6,6 +6,7 @@ import pprint
 
 import coolname
 from datasets import disable_caching
+import torch
 from transformer_document_embedding.scripts.common import evaluate, load_train_save
 
 from transformer_document_embedding.scripts.utils import (
@@ -95,22 +96,48 @@ def train(config: ExperimentSpec, args: argparse.Namespace) -> dict[str, float]:
         args.name,
         pprint.pformat(config, indent=1),
     )
-    save_config(config, exp_path)
+
+    # In distributed training only the first process writes results
+    distributed = (
+        torch.distributed.is_available() and torch.distributed.is_initialized()
+    )
+    is_main_process = not distributed or torch.distributed.get_rank() == 0
+    if is_main_process:
+        save_config(config, exp_path)
 
     model, head, dataset = load_train_save(
         config,
         load_model_weights_path=args.load_model_weights_path,
         load_head_weights_path=args.load_head_weights_path,
-        save_trained_model=args.save_trained_model,
-        save_trained_head=args.save_trained_head,
+        save_trained_model=is_main_process and args.save_trained_model,
+        save_trained_head=is_main_process and args.save_trained_head,
         exp_path=exp_path,
     )
 
+    if not is_main_process:
+        return {}
+
     return evaluate(
         model, head, dataset, exp_path, evaluation_kwargs=config.evaluation_kwargs
     )
 
 
+def init_distributed(args: argparse.Namespace) -> bool:
+    """Initializes process group if started by `torchrun` with multiple processes."""
+    if int(os.environ.get("WORLD_SIZE", 1)) <= 1:
+        return False
+
+    torch.cuda.set_device(int(os.environ["LOCAL_RANK"]))
+    # Rendezvous is configured by environment variables set by `torchrun`
+    torch.distributed.init_process_group(backend="nccl")
+
+    # Generated names differ between processes, all use the first one's
+    names = [args.name]
+    torch.distributed.broadcast_object_list(names, src=0)
+    args.name = names[0]
+    return True
+
+
 def main() -> None:
     args = parse_args()
 
@@ -120,8 +147,14 @@ def main() -> None:
     if args.disable_hf_caching:
         disable_caching()
 
+    distributed = init_distributed(args)
+
     config = ExperimentSpec.from_dict(load_yaml(args.config))
-    train(config, args)
+    try:
+        train(config, args)
+    finally:
+        if distributed:
+            torch.distributed.destroy_process_group()
 
 
 if __name__ == "__main__":
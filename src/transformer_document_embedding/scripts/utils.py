@@ -1,4 +1,5 @@
 from __future__ import annotations
+import atexit
 import importlib
 import os
 from dataclasses import asdict
@@ -12,12 +13,18 @@ from typing import Any, TYPE_CHECKING
 
 
 if TYPE_CHECKING:
+    from torch.utils.tensorboard.writer import SummaryWriter
     from transformer_document_embedding.scripts.config_specs import (
         BaseValuesSpec,
         ModuleSpec,
     )
 
 
+# Writers are kept open so that repeated logging into the same directory does
+# not create a new event file each time.
+_summary_writers: dict[str, SummaryWriter] = {}
+
+
 def save_config(spec: BaseValuesSpec, path: str) -> None:
     save_path = os.path.join(path, "config.yaml")
     logging.info("Saving config to %s", save_path)
@@ -50,11 +57,30 @@ def init_type(spec: ModuleSpec, **additional_kwargs) -> Any:
     return cls(**spec.kwargs, **additional_kwargs)
 
 
+def get_summary_writer(log_path: str) -> SummaryWriter:
+    if log_path not in _summary_writers:
+        from torch.utils.tensorboard.writer import SummaryWriter
+
+        if len(_summary_writers) == 0:
+            atexit.register(close_summary_writers)
+
+        _summary_writers[log_path] = SummaryWriter(log_path)
+
+    return _summary_writers[log_path]
+
+
+def close_summary_writers() -> None:
+    """Flushes and closes all cached writers."""
+    for writer in _summary_writers.values():
+        writer.close()
+
+    _summary_writers.clear()
+
+
 def log_results(log_path: str, results: dict[str, float]) -> None:
     import torch
-    from torch.utils.tensorboard.writer import SummaryWriter
 
-    writer = SummaryWriter(log_path)
+    writer = get_summary_writer(log_path)
 
     for metric, score in results.items():
         writer.add_scalar(metric, torch.tensor(score), 0)
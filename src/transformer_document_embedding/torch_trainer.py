@@ -6,6 +6,8 @@ from typing import TYPE_CHECKING
 import logging
 import torch
 from torch.cuda.amp.grad_scaler import GradScaler
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
 from torcheval.metrics import Mean
 from tqdm.auto import tqdm
 from transformer_document_embedding.utils.metrics import TrainingMetric
@@ -34,6 +36,7 @@ class TorchTrainer:
         lower_is_better: bool = True,
         device: Optional[Union[torch.device, str]] = None,
         fp16: bool = False,
+        bf16: bool = False,
         max_grad_norm: Optional[float] = None,
         grad_accumulation_steps: int = 1,
         lr_scheduler=None,
@@ -63,13 +66,17 @@ class TorchTrainer:
 
         # Use either float16 for cuda or bfloat16 for cpu
         self._fp16 = fp16
+        # bfloat16 has the range of float32, so gradients need no scaling
+        self._bf16 = bf16
+        assert not (fp16 and bf16), "Only one of fp16 and bf16 can be used."
         self._max_grad_norm = max_grad_norm
         self._grad_accumulation_steps = grad_accumulation_steps
 
         self._validate_every_step = validate_every_step
         self._patience = patience
         self._main_metric_name = main_metric
-        self._lower_is_better = lower_is_better
+        # Folding the direction into a sign lets us always maximize the score
+        self._score_sign = -1.0 if lower_is_better else 1.0
         self._save_model_callback = save_model_callback
 
     @classmethod
@@ -83,7 +90,7 @@ class TorchTrainer:
         self._model.to(self._device)
         self._model.train()
 
-        self._best_val_score = float("inf") if self._lower_is_better else float("-inf")
+        self._best_signed_val_score = float("-inf")
         self._validations_without_improvement = 0
 
         self._scaler = GradScaler() if self._fp16 else None
@@ -108,6 +115,10 @@ class TorchTrainer:
         steps_in_epoch = len(train_data)
 
         for epoch in tqdm(range(epochs), desc="Epoch", disable=not progress_bar):
+            if isinstance(train_data.sampler, DistributedSampler):
+                # Different shuffling each epoch, consistent across processes
+                train_data.sampler.set_epoch(epoch)
+
             for step, batch in tqdm(
                 enumerate(train_data),
                 desc="Batches",
@@ -129,10 +140,7 @@ class TorchTrainer:
                     self._validate(val_data, total_step, progress_bar)
 
                     # TODO: Too much indentation
-                    if (
-                        self._patience is not None
-                        and self._validations_without_improvement >= self._patience
-                    ):
+                    if self._patience_exhausted():
                         logger.info(
                             "%d validations without improvement. Stopping training...",
                             self._validations_without_improvement,
@@ -156,10 +164,35 @@ class TorchTrainer:
                 val_data, total_step=step_count - 1, progress_bar=progress_bar
             )
 
+    def _patience_exhausted(self) -> bool:
+        exhausted = (
+            self._patience is not None
+            and self._validations_without_improvement >= self._patience
+        )
+        if isinstance(self._model, DistributedDataParallel):
+            # Only the first process has a validation logger and so keeps track
+            # of improvements. All processes must stop together, otherwise the
+            # rest would wait for the first in gradient synchronization.
+            stop = torch.tensor(exhausted, device=self._device)
+            torch.distributed.broadcast(stop, src=0)
+            exhausted = bool(stop.item())
+
+        return exhausted
+
     def _validate(
         self, val_data: DataLoader, total_step: int, progress_bar: bool
     ) -> None:
-        self._model.eval()
+        model = self._model
+        if isinstance(model, DistributedDataParallel):
+            if torch.distributed.get_rank() != 0:
+                # Only the first process validates, others learn the outcome
+                # through `_patience_exhausted`
+                return
+
+            # DDP's forward synchronizes buffers across processes
+            model = model.module
+
+        model.eval()
         if self._val_logger is not None:
             self._val_logger.reset_all()
 
@@ -169,7 +202,7 @@ class TorchTrainer:
             desc="Validation batches",
             disable=not progress_bar,
         ):
-            self._validation_step(batch)
+            self._validation_step(model, batch)
 
         # get_value must be called before log, where the metric resets
         new_score = (
@@ -180,19 +213,15 @@ class TorchTrainer:
         if self._val_logger is not None:
             self._val_logger.log(total_step, force=True)
 
-        self._model.train()
+        model.train()
 
         if new_score is None:
             return
 
         # TODO: Option to not do this at all?
-        is_better = (
-            (new_score < self._best_val_score)
-            if self._lower_is_better
-            else (new_score > self._best_val_score)
-        )
-        if is_better:
-            self._best_val_score = new_score
+        signed_score = self._score_sign * new_score
+        if signed_score > self._best_signed_val_score:
+            self._best_signed_val_score = signed_score
             self._validations_without_improvement = 0
 
             if self._save_model_callback is not None:
@@ -201,12 +230,14 @@ class TorchTrainer:
         else:
             self._validations_without_improvement += 1
 
-    def _validation_step(self, batch: dict[str, torch.Tensor]) -> None:
+    def _validation_step(
+        self, model: torch.nn.Module, batch: dict[str, torch.Tensor]
+    ) -> None:
         train_utils.batch_to_device(batch, self._device)
 
         with self._autocast():
             with torch.no_grad():
-                outputs = self._model(**batch)
+                outputs = model(**batch)
                 loss = outputs["loss"]
 
         if self._val_logger is not None:
@@ -222,23 +253,28 @@ class TorchTrainer:
     ) -> None:
         train_utils.batch_to_device(batch, self._device)
 
-        with self._autocast():
-            outputs = self._model(**batch)
-            loss = outputs["loss"] / self._grad_accumulation_steps
+        is_update_step = (
+            (total_step + 1) % self._grad_accumulation_steps == 0 or is_last_step
+        )
 
-        if self._fp16:
-            assert self._scaler is not None, "Scaler must be set for fp16."
-            # For fp16 there could be an underflow in gradients...
-            loss = self._scaler.scale(loss) if self._fp16 else loss
-            assert isinstance(loss, torch.Tensor)
+        with self._no_grad_sync(not is_update_step):
+            with self._autocast():
+                outputs = self._model(**batch)
+                loss = outputs["loss"] / self._grad_accumulation_steps
 
-        loss.backward()
+            if self._fp16:
+                assert self._scaler is not None, "Scaler must be set for fp16."
+                # For fp16 there could be an underflow in gradients...
+                loss = self._scaler.scale(loss) if self._fp16 else loss
+                assert isinstance(loss, torch.Tensor)
+
+            loss.backward()
 
         if self._logger is not None:
             current_lr = (
                 self._lr_scheduler.get_last_lr()[0]
                 if self._lr_scheduler is not None
-                else self._optim.state_dict()["param_groups"][0]["lr"]
+                else self._optim.param_groups[0]["lr"]
             )
 
             # After `loss.backward()` so that gradients are populated
@@ -252,7 +288,7 @@ class TorchTrainer:
                 auto_log=True,
             )
 
-        if (total_step + 1) % self._grad_accumulation_steps == 0 or is_last_step:
+        if is_update_step:
             if self._max_grad_norm is not None:
                 if self._scaler is not None:
                     self._scaler.unscale_(self._optim)
@@ -288,6 +324,21 @@ class TorchTrainer:
         if self._fp16:
             with torch.autocast(device_type=self._device.type):
                 yield
+        elif self._bf16:
+            with torch.autocast(device_type=self._device.type, dtype=torch.bfloat16):
+                yield
+        else:
+            yield
+
+    @contextmanager
+    def _no_grad_sync(self, no_sync: bool) -> Iterator[None]:
+        """Skips synchronization of gradients between processes if requested.
+
+        Used for steps that only accumulate gradients, which are synchronized
+        with the next optimizer step anyway."""
+        if no_sync and isinstance(self._model, DistributedDataParallel):
+            with self._model.no_sync():
+                yield
         else:
             yield
 
@@ -317,23 +368,43 @@ class MetricLogger:
 
         self.loss_metric = None
         if log_loss:
-            self.metrics[self.LOSS_NAME] = TrainingMetric(
+            self.loss_metric = TrainingMetric(
                 self.LOSS_NAME,
                 Mean(),
                 log_frequency=special_metrics_log_frequency,
                 reset_after_log=True,
             )
+            self.metrics[self.LOSS_NAME] = self.loss_metric
 
+        self.lr_metric = None
         if log_lr:
-            self.metrics[self.LR_NAME] = TrainingMetric(
+            self.lr_metric = TrainingMetric(
                 self.LR_NAME,
                 Mean(),
                 log_frequency=special_metrics_log_frequency,
                 reset_after_log=True,
             )
+            self.metrics[self.LR_NAME] = self.lr_metric
+
+        # Resolved once so that updates don't compare names of all metrics
+        self._output_metrics = [
+            metric
+            for metric in self.metrics.values()
+            if metric is not self.loss_metric and metric is not self.lr_metric
+        ]
+
+        # Distinct frequencies so that steps with nothing to log are skipped
+        # without going through all metrics
+        self._log_frequencies = {
+            metric.log_frequency
+            for metric in self.metrics.values()
+            if metric.log_frequency is not None
+        }
 
         self.writer = SummaryWriter(path.join(log_dir, name))
 
+    # One inference mode context per step instead of one per metric
+    @torch.inference_mode()
     def add_scalars(
         self,
         outputs: dict[str, torch.Tensor],
@@ -343,13 +414,12 @@ class MetricLogger:
         total_step: Optional[int] = None,
         auto_log: bool = False,
     ) -> None:
-        for metric in self.metrics.values():
-            if metric.name == self.LOSS_NAME and loss is not None:
-                metric.update(loss)
-            elif metric.name == self.LR_NAME and lr is not None:
-                metric.update(lr)
-            else:
-                metric.update(outputs, batch)
+        if self.loss_metric is not None and loss is not None:
+            self.loss_metric.update(loss)
+        if self.lr_metric is not None and lr is not None:
+            self.lr_metric.update(lr)
+        for metric in self._output_metrics:
+            metric.update(outputs, batch)
 
         if auto_log and total_step is not None:
             self.log(total_step, force=False)
@@ -359,16 +429,39 @@ class MetricLogger:
             metric.to(device)
 
     def log(self, total_step: int, force: bool = False) -> None:
-        for metric in self.metrics.values():
-            if force or (
+        if not force and all(total_step % freq != 0 for freq in self._log_frequencies):
+            return
+
+        to_log = [
+            metric
+            for metric in self.metrics.values()
+            if force
+            or (
                 metric.log_frequency is not None
                 and total_step % metric.log_frequency == 0
-            ):
-                self.writer.add_scalar(metric.name, metric.compute(), total_step)
-                if metric.reset_after_log:
-                    metric.reset()
+            )
+        ]
+        if len(to_log) == 0:
+            return
 
-        self.writer.flush()
+        scores = [
+            torch.as_tensor(metric.compute()).detach().reshape(()) for metric in to_log
+        ]
+        # Transfer all scores to host at once rather than synchronizing per metric
+        score_values = torch.stack(
+            [score.to(scores[0].device, torch.float64) for score in scores]
+        ).tolist()
+
+        for metric, score in zip(to_log, score_values, strict=True):
+            self.writer.add_scalar(metric.name, score, total_step)
+            if metric.reset_after_log:
+                metric.reset()
+
+        # The writer persists events from a background thread on its own. Only
+        # explicit logs (e.g. after validation) wait for the data to hit the
+        # disk so that training steps are not blocked by I/O.
+        if force:
+            self.writer.flush()
 
     def reset_all(self) -> None:
         for metric in self.metrics.values():
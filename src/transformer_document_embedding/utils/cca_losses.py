@@ -1,4 +1,5 @@
 from __future__ import annotations
+import logging
 import torch
 from typing import TYPE_CHECKING, Any, Union
 
@@ -11,6 +12,8 @@ from transformer_document_embedding.utils.net_helpers import (
 if TYPE_CHECKING:
     from typing import Optional
 
+logger = logging.getLogger(__name__)
+
 
 class CCALoss(torch.nn.Module):
     def __init__(
@@ -28,19 +31,41 @@ class CCALoss(torch.nn.Module):
 
     def _covariance(
         self,
-        x: torch.Tensor,
-        y: torch.Tensor,
+        views_bar: torch.Tensor,
+        view1_dim: int,
         *,
         add_regularization: bool = False,
-    ) -> torch.Tensor:
-        n = x.size(1)  # observation count
-        cov = (1 / (n - 1)) * torch.matmul(x, y.T)
+    ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Returns cross-covariance and covariances of both views.
+
+        Parameters:
+        -----------
+            views_bar: torch.Tensor
+                Centered features of both views concatenated, observations as
+                rows.
+            view1_dim: int
+                Number of features of the first view.
+        """
+        n = views_bar.size(0)  # observation count
+        # Single matmul for all three blocks, scaled within the GEMM itself. With
+        # zero beta the input is ignored, so a scalar zero suffices.
+        cov = torch.addmm(
+            views_bar.new_zeros(()),
+            views_bar.T,
+            views_bar,
+            beta=0,
+            alpha=1 / (n - 1),
+        )
+
+        if add_regularization:
+            # Regularizes only the covariances of the views, which lie on the
+            # diagonal of the joint covariance
+            cov.diagonal().add_(self._reg_constant)
 
-        m = x.size(0)  # features count
         return (
-            cov + self._reg_constant * torch.eye(m, device=x.device)
-            if add_regularization
-            else cov
+            cov[:view1_dim, view1_dim:],
+            cov[:view1_dim, :view1_dim],
+            cov[view1_dim:, view1_dim:],
         )
 
     def _return_computation(
@@ -51,66 +76,61 @@ class CCALoss(torch.nn.Module):
     def _compute_covariance_matrices(
         self, view1: torch.Tensor, view2: torch.Tensor
     ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
-        # So that observations are columns, features are rows
-        view1, view2 = view1.T, view2.T
+        views = torch.cat((view1, view2), dim=1)
+        # Centering in place, the concatenated views are not needed anymore
+        views_bar = views.sub_(views.mean(dim=0))
 
-        view1_bar = view1 - view1.mean(dim=1).unsqueeze(dim=1)
-        view2_bar = view2 - view2.mean(dim=1).unsqueeze(dim=1)
+        return self._covariance(views_bar, view1.size(1), add_regularization=True)
 
-        sigma = self._covariance(view1_bar, view2_bar)
-        sigma_1 = self._covariance(view1_bar, view1_bar, add_regularization=True)
-        sigma_2 = self._covariance(view2_bar, view2_bar, add_regularization=True)
-
-        return sigma, sigma_1, sigma_2
-
-    def forward(
-        self, view1: torch.Tensor, view2: torch.Tensor
-    ) -> dict[str, torch.Tensor]:
-        device = view1.device
-
-        sigma, sigma_1, sigma_2 = self._compute_covariance_matrices(view1, view2)
+    def _whiten_with_cholesky(
+        self, sigma: torch.Tensor, sigma_1: torch.Tensor, sigma_2: torch.Tensor
+    ) -> torch.Tensor:
+        L1 = torch.linalg.cholesky(sigma_1)
+        L2 = torch.linalg.cholesky(sigma_2)
+
+        # L1^-1 @ sigma @ L2^-T has the same singular values as
+        # sigma_1^-1/2 @ sigma @ sigma_2^-1/2
+        T = torch.linalg.solve_triangular(L1, sigma, upper=False)
+        return torch.linalg.solve_triangular(L2, T.T, upper=False).T
+
+    def _large_eigvals_rsqrt(self, eigvals: torch.Tensor) -> torch.Tensor:
+        # To increase stability, give up eigenvectors with small eigenvalues.
+        # Zeroing their scale is the same as dropping them, but keeps the shape
+        # fixed, so no synchronization with the device is needed. Clamping
+        # keeps gradients of the discarded branch finite.
+        return torch.where(
+            eigvals > self._eps, eigvals.clamp_min(self._eps).rsqrt(), 0
+        )
 
+    def _whiten_with_eigh(
+        self, sigma: torch.Tensor, sigma_1: torch.Tensor, sigma_2: torch.Tensor
+    ) -> torch.Tensor:
         D1, V1 = torch.linalg.eigh(sigma_1)
         D2, V2 = torch.linalg.eigh(sigma_2)
 
-        # To increase stability, give up eigenvectors with small eigenvalues
-        # Indices of rows with elements of `D1` larger than `eps`
-        large_eigh_idxs = torch.gt(D1, self._eps).nonzero()[:, 0]
-        D1 = D1[large_eigh_idxs]
-        # Forget eigenvectors with small eigenvalues
-        V1 = V1[:, large_eigh_idxs]
-
-        large_eigh_idxs = torch.gt(D2, self._eps).nonzero()[:, 0]
-        D2 = D2[large_eigh_idxs]
-        V2 = V2[:, large_eigh_idxs]
-
-        sigma_1_root_inv = V1 @ torch.diag(D1**-0.5) @ V1.T
-        sigma_2_root_inv = V2 @ torch.diag(D2**-0.5) @ V2.T
+        # Scaling columns instead of multiplying by a diagonal matrix
+        sigma_1_root_inv = (V1 * self._large_eigvals_rsqrt(D1)) @ V1.T
+        sigma_2_root_inv = (V2 * self._large_eigvals_rsqrt(D2)) @ V2.T
 
-        # The matrix whose singular values are canonical correlations
-        A = sigma_1_root_inv @ sigma @ sigma_2_root_inv
+        return sigma_1_root_inv @ sigma @ sigma_2_root_inv
 
-        if self._output_dim is None:
-            # We are using all singular values
-            corr = torch.trace(torch.sqrt(A.T @ A))
-            return self._return_computation(-corr)
+    def forward(
+        self, view1: torch.Tensor, view2: torch.Tensor
+    ) -> dict[str, torch.Tensor]:
+        sigma, sigma_1, sigma_2 = self._compute_covariance_matrices(view1, view2)
 
-        A_times_A = A.T @ A
-        A_times_A = torch.add(
-            A_times_A,
-            (self._reg_constant * torch.eye(A_times_A.shape[0]).to(device)),
-        )
-        eigenvalues = torch.linalg.eigvalsh(A_times_A)
-        eigenvalues = torch.where(
-            eigenvalues > self._eps,
-            eigenvalues,
-            (torch.ones(eigenvalues.shape).double() * self._eps).to(device),
-        )
+        try:
+            A = self._whiten_with_cholesky(sigma, sigma_1, sigma_2)
+        except torch.linalg.LinAlgError:
+            # Covariances which are not numerically positive definite
+            A = self._whiten_with_eigh(sigma, sigma_1, sigma_2)
 
-        eigenvalues = eigenvalues.topk(self._output_dim)[0]
-        corr = torch.sum(torch.sqrt(eigenvalues))
+        # Singular values of `A` are the canonical correlations
+        correlations = torch.linalg.svdvals(A)
+        if self._output_dim is not None:
+            correlations = correlations.topk(self._output_dim)[0]
 
-        return self._return_computation(-corr)
+        return self._return_computation(-correlations.sum())
 
 
 class RunningCCALoss(CCALoss):
@@ -155,38 +175,45 @@ class RunningCCALoss(CCALoss):
 
         self._beta_mu = beta_mu
         self._beta_sigma = beta_sigma
-        self._beta_mu_power = 1
-        self._beta_sigma_power = 1
+        # Kept on device so that bias corrections do not mix in Python scalars.
+        # Not persistent, to match the behaviour of not saving them at all.
+        self.register_buffer(
+            "_beta_mu_power", torch.ones((), **factory_kwargs), persistent=False
+        )
+        self._beta_mu_power: torch.Tensor
+        self.register_buffer(
+            "_beta_sigma_power", torch.ones((), **factory_kwargs), persistent=False
+        )
+        self._beta_sigma_power: torch.Tensor
 
     @staticmethod
-    def _running_update(
-        beta: float, old: torch.Tensor, new: torch.Tensor
+    def _running_update_(
+        beta: float, running: torch.Tensor, new: torch.Tensor
     ) -> torch.Tensor:
-        return old.detach() * beta + (1 - beta) * new
+        # Detaching in place cuts the graph of the previous step, interpolation
+        # computes `beta * running + (1 - beta) * new` in a single kernel. Under
+        # autocast the new statistics may be of lower precision.
+        return running.detach_().lerp_(new.to(running.dtype), 1 - beta)
 
     def _compute_covariance_matrices(
         self, view1: torch.Tensor, view2: torch.Tensor
     ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
-        # So that observations are columns, features are rows
-        view1, view2 = view1.T, view2.T
-
         view1_mean, view2_mean = self._compute_means(view1, view2)
 
-        view1_bar = view1 - view1_mean.unsqueeze(dim=1)
-        view2_bar = view2 - view2_mean.unsqueeze(dim=1)
+        views = torch.cat((view1, view2), dim=1)
+        views_bar = views.sub_(torch.cat((view1_mean, view2_mean)))
 
-        new_sigma = self._covariance(view1_bar, view2_bar)
-        new_sigma1 = self._covariance(view1_bar, view1_bar)
-        new_sigma2 = self._covariance(view2_bar, view2_bar)
+        new_sigma, new_sigma1, new_sigma2 = self._covariance(views_bar, view1.size(1))
 
-        self.sigma = self._running_update(self._beta_sigma, self.sigma, new_sigma)
-        self.sigma1 = self._running_update(self._beta_sigma, self.sigma1, new_sigma1)
-        self.sigma2 = self._running_update(self._beta_sigma, self.sigma2, new_sigma2)
+        self._running_update_(self._beta_sigma, self.sigma, new_sigma)
+        self._running_update_(self._beta_sigma, self.sigma1, new_sigma1)
+        self._running_update_(self._beta_sigma, self.sigma2, new_sigma2)
 
-        self._beta_sigma_power *= self._beta_sigma
-        sigma = self.sigma / (1 - self._beta_sigma_power)
-        sigma1 = self.sigma1 / (1 - self._beta_sigma_power)
-        sigma2 = self.sigma2 / (1 - self._beta_sigma_power)
+        self._beta_sigma_power.mul_(self._beta_sigma)
+        bias_correction = (1 - self._beta_sigma_power).reciprocal_()
+        sigma = self.sigma * bias_correction
+        sigma1 = self.sigma1 * bias_correction
+        sigma2 = self.sigma2 * bias_correction
 
         return sigma, sigma1, sigma2
 
@@ -197,17 +224,17 @@ class RunningCCALoss(CCALoss):
         Parameters:
         -----------
             view1: torch.Tensor
-                Embeddings of first view as columns.
+                Embeddings of first view as rows.
             view2: torch.Tensor
-                Embeddings of second view as columns.
+                Embeddings of second view as rows.
         """
-        self.mu1 = self._running_update(self._beta_mu, self.mu1, view1.mean(dim=1))
+        self._running_update_(self._beta_mu, self.mu1, view1.mean(dim=0))
+        self._running_update_(self._beta_mu, self.mu2, view2.mean(dim=0))
 
-        self.mu2 = self._running_update(self._beta_mu, self.mu2, view2.mean(dim=1))
-
-        self._beta_mu_power *= self._beta_mu
-        mu1 = self.mu1 / (1 - self._beta_mu_power)
-        mu2 = self.mu2 / (1 - self._beta_mu_power)
+        self._beta_mu_power.mul_(self._beta_mu)
+        bias_correction = (1 - self._beta_mu_power).reciprocal_()
+        mu1 = self.mu1 * bias_correction
+        mu2 = self.mu2 * bias_correction
         return mu1, mu2
 
     def _return_computation(
@@ -215,7 +242,8 @@ class RunningCCALoss(CCALoss):
     ) -> dict[str, torch.Tensor]:
         return {
             **super()._return_computation(neg_correlation),
-            "covariance_mat": self.sigma.detach(),
+            # Cloned, since the buffer is updated in place by the next step
+            "covariance_mat": self.sigma.detach().clone(),
             "sigma2": (self.sigma2 / (1 - self._beta_sigma_power)).detach(),
         }
 
@@ -280,7 +308,11 @@ class StochasticDecorrelationLoss(torch.nn.Module):
         self.batch_norm = torch.nn.BatchNorm1d(dimension, affine=False)
 
         self.alpha = alpha
-        self.norm_factor = 0
+        # On device, so that a compiled forward isn't specialized to its value
+        self.register_buffer(
+            "norm_factor", torch.zeros((), **factory_kwargs), persistent=False
+        )
+        self.norm_factor: torch.Tensor
 
     def forward(self, inputs: torch.Tensor) -> torch.Tensor:
         inputs = self.batch_norm(inputs)
@@ -291,15 +323,15 @@ class StochasticDecorrelationLoss(torch.nn.Module):
         m = inputs.size(0)
 
         new_sigma = (1 / (m - 1)) * inputs.T @ inputs
-        sigma = self.alpha * self.sigma.detach() + new_sigma
+        sigma = torch.add(new_sigma, self.sigma.detach(), alpha=self.alpha)
 
         if self.training:
-            self.norm_factor = self.alpha * self.norm_factor + 1
+            self.norm_factor.mul_(self.alpha).add_(1)
             self.sigma = sigma
 
-        abs_sigma = (sigma / self.norm_factor).abs()
-
-        loss = abs_sigma.sum() - abs_sigma.trace()
+        # Normalization factor is positive, so it can divide the sum instead
+        abs_sigma = sigma.abs()
+        loss = (abs_sigma.sum() - abs_sigma.diagonal().sum()) / self.norm_factor
 
         # My addition: mean instead of sum, to help with fine-tuning SDL vs L2 norm
         loss /= (n * n) - n
@@ -316,6 +348,7 @@ class DeepNet(torch.nn.Module):
         blocks_config: list[dict[str, Any]],
         input_features: int,
         *args,
+        compile_blocks: bool = False,
         **kwargs,
     ) -> None:
         super().__init__(*args, **kwargs)
@@ -345,7 +378,16 @@ class DeepNet(torch.nn.Module):
 
             block_features.append(out_features)
             in_features = out_features
-            blocks.append(torch.nn.Sequential(*layers))
+            block = torch.nn.Sequential(*layers)
+            if compile_blocks and len(layers) > 0:
+                # Fuses normalization, activation and dropout into fewer
+                # kernels. Compiles in place, so parameter names stay the same.
+                # `Module.compile` is available only since torch 2.2.
+                if hasattr(block, "compile"):
+                    block.compile()
+                else:
+                    logger.warning("Cannot compile DeepNet blocks with torch<2.2.")
+            blocks.append(block)
 
         self._features = block_features
 
@@ -3,6 +3,7 @@ from __future__ import annotations
 from typing import TYPE_CHECKING, Iterator, Optional, cast, Any
 from gensim.models import doc2vec
 from nltk.stem import PorterStemmer
+import numpy as np
 from typing import Callable
 
 from transformer_document_embedding.datasets import col
@@ -13,22 +14,52 @@ if TYPE_CHECKING:
 
 
 class GensimCorpus:
+    # Number of documents fetched at once when iterating in shuffled order
+    SHUFFLED_FETCH_SIZE = 1024
+
     def __init__(
-        self, dataset: Dataset, text_pre_processor: TextPreProcessor, num_proc: int = 0
+        self,
+        dataset: Dataset,
+        text_pre_processor: TextPreProcessor,
+        num_proc: int = 0,
+        shuffle: bool = False,
+        seed: Optional[int] = None,
     ) -> None:
         self._text_preprocessor = text_pre_processor
         self._dataset = dataset.map(self.doc_to_gensim_doc, num_proc=num_proc)
+        self._init_order(shuffle, seed)
+
+    def _init_order(self, shuffle: bool, seed: Optional[int]) -> None:
+        self._rng = np.random.default_rng(seed)
+        self._order = None
+        if shuffle:
+            self.reshuffle()
+
+    def reshuffle(self) -> None:
+        """Draws new order of documents without copying the underlying dataset."""
+        self._order = self._rng.permutation(len(self._dataset))
 
     def __len__(self) -> int:
         return len(self._dataset)
 
     def __iter__(self) -> Iterator[doc2vec.TaggedDocument]:
-        for gensim_doc in self._dataset:
+        gensim_docs = self._dataset if self._order is None else self._iter_shuffled()
+        for gensim_doc in gensim_docs:
             # To get rid of warnings that doc can also be a list
             gensim_doc = cast(dict[str, Any], gensim_doc)
 
             yield doc2vec.TaggedDocument(gensim_doc["words"], [gensim_doc["tag"]])
 
+    def _iter_shuffled(self) -> Iterator[dict[str, Any]]:
+        assert self._order is not None
+
+        # Fetching in batches avoids per-row overhead of random access
+        for start in range(0, len(self._order), self.SHUFFLED_FETCH_SIZE):
+            indices = self._order[start : start + self.SHUFFLED_FETCH_SIZE]
+            docs = self._dataset[indices]
+            for words, tag in zip(docs["words"], docs["tag"], strict=True):
+                yield {"words": words, "tag": tag}
+
     def doc_to_gensim_doc(self, doc: dict[str, Any]) -> dict[str, Any]:
         return {
             "words": self._text_preprocessor(doc[col.TEXT]),
@@ -3,15 +3,11 @@ from abc import abstractmethod
 from dataclasses import asdict, dataclass
 import itertools
 import logging
-from time import time
 
-import warnings
 from typing import TYPE_CHECKING, Any, Callable, Union
-from sklearn.cross_decomposition import CCA
 from cca_zoo.linear import CCA as ZooCCA
 
 
-import numpy as np
 import torch
 from torcheval.metrics import Max, Mean, Metric
 from torcheval.metrics.toolkit import clone_metric
@@ -43,8 +39,8 @@ class TrainingMetric:
     def device(self) -> torch.device:
         return self.metric.device
 
-    @torch.inference_mode()
     def update(self, *args) -> None:
+        """Updates the metric. Expected to be called in inference mode."""
         self.update_fn(self.metric, *args)
 
     def clone(self, **kwargs_overwrite) -> TrainingMetric:
@@ -65,15 +61,32 @@ class TrainingMetric:
 
 
 class VMemMetric(TrainingMetric):
+    """Maximum of GPU memory reserved by torch's allocator, in MB.
+
+    The caching allocator rarely releases memory, so the reserved memory is
+    sampled only when the metric is computed instead of on every step.
+    """
+
     def __init__(self, log_frequency: int, reset_after_log: bool = False) -> None:
         super().__init__(
             "used_vmem", Max(), log_frequency, self._update_fn, reset_after_log
         )
 
     def _update_fn(self, metric: Metric, *_) -> None:
-        mem_used = torch.cuda.memory_reserved(metric.device)
-        mem_used = mem_used // 1024**2
-        metric.update(torch.tensor(mem_used))
+        pass
+
+    def compute(self) -> Any:
+        mem_used = torch.cuda.memory_reserved(self.device) // 1024**2
+        self.metric.update(torch.tensor(mem_used, device=self.device))
+        return super().compute()
+
+    def clone(self, **kwargs_overwrite) -> TrainingMetric:
+        kwargs = {
+            "log_frequency": self.log_frequency,
+            "reset_after_log": self.reset_after_log,
+        }
+        kwargs.update(kwargs_overwrite)
+        return VMemMetric(**kwargs)
 
 
 class EmbeddingMSEWithCol(TrainingMetric):
@@ -116,13 +129,14 @@ class EmbeddingMSEWithCol(TrainingMetric):
         mse = (model_embeddings - col_emebddings) ** 2
         mse = mse.mean(dim=1)
 
-        if self.max_input_length is not None:
-            mask = batch[col.LENGTH] <= self.max_input_length
-            # mask is 1D
-            non_masked_idxs = mask.nonzero().squeeze()
-            mse = mse.index_select(0, non_masked_idxs)
+        if self.max_input_length is None:
+            metric.update(mse)
+            return
 
-        metric.update(mse)
+        # Weighting by the mask instead of selecting non-masked rows avoids
+        # `nonzero`, which synchronizes with the host
+        mask = batch[col.LENGTH] <= self.max_input_length
+        metric.update(mse, weight=mask.to(mse.dtype))
 
 
 class EmbeddingCosineDistanceWithCol(TrainingMetric):
@@ -155,21 +169,29 @@ class EmbeddingCosineDistanceWithCol(TrainingMetric):
         outputs: dict[str, torch.Tensor],
         batch: dict[str, torch.Tensor],
     ) -> None:
-        cos_dist = 1 - torch.nn.functional.cosine_similarity(
+        cos_dist = torch.nn.functional.cosine_similarity(
             outputs[col.EMBEDDING],
             batch[self.col_name],
             dim=1,
         )
-        if self.max_input_length is not None:
-            mask = batch[col.LENGTH] <= self.max_input_length
-            # mask is 1D
-            non_masked_idxs = mask.nonzero().squeeze()
-            cos_dist = cos_dist.index_select(0, non_masked_idxs)
-        metric.update(cos_dist)
+        # In place, not to allocate another batch-sized temporary
+        cos_dist.neg_().add_(1)
+        if self.max_input_length is None:
+            metric.update(cos_dist)
+            return
+
+        mask = batch[col.LENGTH] <= self.max_input_length
+        metric.update(cos_dist, weight=mask.to(cos_dist.dtype))
 
 
 class WindowedMetric(Metric):
-    """Base class for all metrics that need fixed window in order to be comparable."""
+    """Base class for all metrics that need fixed window in order to be comparable.
+
+    Views are stored in ring buffers of `window_size` rows, so updates copy
+    only the new rows instead of concatenating the whole window. Full windows
+    are passed to `_compute_with_full_window` as they are in the buffers, i.e.
+    rotated, so the computed statistic must not depend on the order of samples.
+    """
 
     def __init__(
         self,
@@ -180,10 +202,16 @@ class WindowedMetric(Metric):
     ) -> None:
         super().__init__(device=device)
 
+        # Buffers are allocated on first update, once views' dimensions are known
         self._add_state(
             "views", [torch.tensor([], device=device) for _ in range(num_views)]
         )
         self.views: list[torch.Tensor]
+        # Index of the next row to write and number of valid rows in buffers
+        self._add_state("_cursor", 0)
+        self._cursor: int
+        self._add_state("_count", 0)
+        self._count: int
 
         self._window_shift = window_shift
         self._window_size = window_size
@@ -199,16 +227,13 @@ class WindowedMetric(Metric):
 
     @property
     def has_full_window(self) -> bool:
-        samples = self.views[0].size(0)
-        return samples >= self.window_size
+        return self._count >= self.window_size
 
     @torch.inference_mode()
     def update(self, *new_views: torch.Tensor) -> WindowedMetric:
-        for i, new_view in enumerate(new_views):
-            self.views[i] = torch.cat((self.views[i], new_view), dim=0)
+        self._write(new_views)
 
         if self.has_full_window:
-            self._truncate_views()
             current_result = self._compute_with_full_window()
 
             if not torch.isnan(current_result):
@@ -235,25 +260,61 @@ class WindowedMetric(Metric):
     def _compute_with_full_window(self) -> torch.Tensor:
         pass
 
+    # Buffers are allocated in inference mode by `update`, so they can be written
+    # to only in inference mode
+    @torch.inference_mode()
     def merge_state(self, metrics: Iterable[WindowedCCAMetric]) -> WindowedMetric:
         views = [[] for _ in range(len(self.views))]
         self._average.merge_state([m._average for m in metrics])
         for metric in itertools.chain([self], metrics):
             assert len(metric.views) == len(views)
-            for i, view in enumerate(metric.views):
+            for i, view in enumerate(metric._chronological_views()):
                 views[i].append(view)
 
-        self.views = [torch.concat(view) for view in views]
-
-        if self.has_full_window:
-            self._truncate_views()
+        self._cursor = 0
+        self._count = 0
+        self._write([torch.concat(view) for view in views])
         return self
 
-    def _truncate_views(self) -> None:
-        self.views = [view[-self.window_size :] for view in self.views]
+    def _write(self, new_views: Iterable[torch.Tensor]) -> None:
+        new_views = list(new_views)
+        # Older rows would be overwritten by the newer ones anyway
+        new_views = [view[-self.window_size :] for view in new_views]
+        new_rows = new_views[0].size(0)
+
+        for i, new_view in enumerate(new_views):
+            if self.views[i].size(0) != self.window_size:
+                self.views[i] = torch.empty(
+                    (self.window_size, *new_view.shape[1:]),
+                    dtype=new_view.dtype,
+                    device=new_view.device,
+                )
+
+            # Write to the end of the buffer and wrap around
+            head_rows = min(new_rows, self.window_size - self._cursor)
+            self.views[i][self._cursor : self._cursor + head_rows] = new_view[
+                :head_rows
+            ]
+            self.views[i][: new_rows - head_rows] = new_view[head_rows:]
+
+        self._cursor = (self._cursor + new_rows) % self.window_size
+        self._count = min(self._count + new_rows, self.window_size)
+
+    def _chronological_views(self) -> list[torch.Tensor]:
+        if self._count == 0:
+            return [view[:0] for view in self.views]
+
+        start = (self._cursor - self._count) % self.window_size
+        if start < self._cursor:
+            return [view[start : self._cursor] for view in self.views]
+
+        return [
+            torch.concat((view[start:], view[: self._cursor])) for view in self.views
+        ]
 
     def _shift_window(self) -> None:
-        self.views = [view[self.window_shift :] for view in self.views]
+        # The oldest rows are just forgotten and later overwritten
+        self._count = max(0, self._count - self.window_shift)
 
     def reset(self):
         self._average.reset()
@@ -261,7 +322,7 @@ class WindowedMetric(Metric):
 
 
 class WindowedCCAMetric(WindowedMetric):
-    """CCA computed by sklearn.
+    """CCA computed in closed form on the views' device.
 
     It has a fixed window because the size of window influences the result. By
     having fixed window we make sure that the values are always informative and
@@ -273,8 +334,14 @@ class WindowedCCAMetric(WindowedMetric):
         n_components: int,
         window_size: int,
         window_shift: int,
+        average: bool = False,
         device: Optional[torch.device] = None,
     ) -> None:
+        """
+        Parameters:
+        - average: bool
+            Whether to report mean instead of sum of canonical correlations.
+        """
         super().__init__(
             window_size=window_size,
             window_shift=window_shift,
@@ -287,6 +354,7 @@ class WindowedCCAMetric(WindowedMetric):
         ), "window size must be at least `n_components` long"
 
         self.n_components = n_components
+        self.average = average
 
     @torch.inference_mode()
     def _compute_with_full_window(self) -> torch.Tensor:
@@ -298,40 +366,23 @@ class WindowedCCAMetric(WindowedMetric):
         if self.n_components > min(view1_dim, view2_dim, samples):
             return torch.tensor(torch.nan, device=self.views[0].device)
 
-        start_time = time()
-        cca = CCA(n_components=self.n_components, tol=1e-2, max_iter=100000)
         try:
-            # No category keyword for python 3.10 compatibility
-            with warnings.catch_warnings():
-                views1_, views2_ = cca.fit_transform(
-                    self.views[0].numpy(force=True),
-                    self.views[1].numpy(force=True),
-                )
+            correlations = self._canonical_correlations()
+        except torch.linalg.LinAlgError as e:
+            logger.warn("Error when computing CCA: %s", e)
+            return torch.tensor(torch.nan, device=self.views[0].device)
 
-            correlation = (
-                np.corrcoef(views1_, views2_, rowvar=False)
-                .diagonal(offset=self.n_components)
-                .sum()
-            )
-            end_time = time()
-            logger.info(
-                "CCA: dim %d, window size %d, seconds: %f",
-                self.n_components,
-                self.window_size,
-                end_time - start_time,
-            )
+        return correlations.mean() if self.average else correlations.sum()
 
-            return torch.tensor(correlation, device=self.views[0].device)
-        except np.linalg.LinAlgError as e:
-            logger.warn("Error when computing CCA: %s", e)
-            end_time = time()
-            logger.info(
-                "CCA: dim %d, window size %d, seconds: %f",
-                self.n_components,
-                self.window_size,
-                end_time - start_time,
-            )
-            return torch.tensor(np.nan, device=self.views[0].device)
+    def _canonical_correlations(self) -> torch.Tensor:
+        # Canonical correlations are the singular values of the product of
+        # orthonormal bases of the centered views. Views may be in half
+        # precision (e.g. under autocast), for which there are no QR and SVD
+        # kernels.
+        views = [view.double() for view in self.views]
+        bases = [torch.linalg.qr(view - view.mean(dim=0))[0] for view in views]
+        correlations = torch.linalg.svdvals(bases[0].T @ bases[1])
+        return correlations[: self.n_components].clamp(max=1)
 
 
 class WindowedCCAMetricTorch(WindowedCCAMetric):
@@ -410,10 +461,13 @@ class WindowedAbsCrossCorrelationMetric(WindowedMetric):
         )
 
     def _compute_with_full_window(self) -> torch.Tensor:
-        all_vars = torch.concat((self.views[0].T, self.views[1].T), dim=0)
-        view1_dim = self.views[0].size(1)
+        # Only the cross block of the joint correlation matrix is computed
+        view1_bar = self.views[0] - self.views[0].mean(dim=0)
+        view2_bar = self.views[1] - self.views[1].mean(dim=0)
 
-        cross_corr_coefs = torch.corrcoef(all_vars)[:view1_dim, view1_dim:]
+        norms1 = torch.linalg.vector_norm(view1_bar, dim=0)
+        norms2 = torch.linalg.vector_norm(view2_bar, dim=0)
+        cross_corr_coefs = (view1_bar.T @ view2_bar) / torch.outer(norms1, norms2)
         mean_abs_cross_corr = cross_corr_coefs.abs().mean()
 
         return mean_abs_cross_corr
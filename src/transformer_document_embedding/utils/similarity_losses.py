@@ -4,6 +4,7 @@ Semi-required interface:
 
 - Should support masking of inputs to use them in `StructuralContextualHead`.
 - All return dicts (for consistency)
+- Losses are per input, of shape (batch_size,), with or without a mask
 """
 
 from __future__ import annotations
@@ -18,9 +19,9 @@ if TYPE_CHECKING:
 def index_nonzero(
     mask: torch.Tensor, outputs: torch.Tensor, targets: torch.Tensor
 ) -> tuple[torch.Tensor, torch.Tensor]:
-    # Assume shape (batch_size, 1) or same mask for all dimensions of
-    # given input
-    batch_idxs = mask.nonzero().squeeze()
+    # Assume mask of shape (batch_size,). Indices are computed once for both
+    # inputs, since each `nonzero` waits for the device.
+    batch_idxs = mask.nonzero().squeeze(1)
     outputs = outputs.index_select(dim=0, index=batch_idxs)
     targets = targets.index_select(dim=0, index=batch_idxs)
 
@@ -28,11 +29,8 @@ def index_nonzero(
 
 
 def add_zeros(mask: torch.Tensor, x: torch.Tensor) -> torch.Tensor:
-    res = torch.zeros_like(mask, dtype=x.dtype)
-    # Looks weird but the gradient propagates just fine (tested it)
-    res[mask.nonzero().squeeze()] = x
-
-    return res
+    # Scatters on device without computing indices of the masked rows
+    return torch.zeros_like(mask, dtype=x.dtype).masked_scatter(mask, x)
 
 
 class MaxMarginalsLoss(torch.nn.Module):
@@ -64,7 +62,7 @@ class MaxMarginalsLoss(torch.nn.Module):
             return {
                 key: torch.zeros(
                     batch_size,
-                    dtype=torch.float32,
+                    dtype=outputs.dtype,
                     device=outputs.device,
                 )
                 for key in ["loss", "marginals_positive", "marginals_negative"]
@@ -111,7 +109,8 @@ class ContrastiveLoss(torch.nn.Module):
         logits /= torch.linalg.vector_norm(targets, dim=1).unsqueeze(0)
 
         labels = torch.arange(outputs.size(0), device=logits.device)
-        xentropy = torch.nn.functional.cross_entropy(logits, labels)
+        # Loss per input, so that it can be masked and weighted like other losses
+        xentropy = torch.nn.functional.cross_entropy(logits, labels, reduction="none")
 
         if mask is not None:
             xentropy = add_zeros(mask, xentropy)
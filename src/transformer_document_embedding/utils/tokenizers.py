@@ -9,6 +9,7 @@ from typing import TYPE_CHECKING, Generic, Mapping, MutableMapping, TypeVar
 
 import torch
 from torch.utils.data import DataLoader, Sampler
+from torch.utils.data.distributed import DistributedSampler
 
 from transformer_document_embedding.datasets import col
 
@@ -416,7 +417,21 @@ def create_tokenized_data_loader(
         list({col.ID, col.ID_1, col.ID_0} & set(data.column_names))
     )
 
-    if training:
+    distributed = (
+        torch.distributed.is_available() and torch.distributed.is_initialized()
+    )
+    if training and distributed and sampling != "default":
+        # Length-based samplers aren't sharded, so each process would go
+        # through the whole dataset
+        raise ValueError(
+            f"Sampling '{sampling}' is not supported in distributed training."
+        )
+
+    distributed_sampler = None
+    if training and distributed:
+        # Each process gets its own shard, shuffled consistently across processes
+        distributed_sampler = DistributedSampler(data, shuffle=True)
+    elif training:
         data = data.shuffle()
 
     collator = FastDataCollator(
@@ -427,6 +442,8 @@ def create_tokenized_data_loader(
     dataloader_kwargs: dict[str, Any] = {
         "collate_fn": collator,
     }
+    if distributed_sampler is not None:
+        dataloader_kwargs["sampler"] = distributed_sampler
 
     if batch_size is not None:
         dataloader_kwargs["batch_size"] = batch_size
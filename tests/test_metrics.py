@@ -0,0 +1,15 @@
+import torch
+
+from transformer_document_embedding.utils.metrics import WindowedCCAMetric
+
+
+def test_windowed_cca_with_half_precision_views() -> None:
+    metric = WindowedCCAMetric(n_components=2, window_size=16, window_shift=16)
+
+    view1 = torch.randn(16, 4)
+    view2 = view1 @ torch.randn(4, 4) + 0.1 * torch.randn(16, 4)
+    metric.update(view1.half(), view2.half())
+
+    correlation = metric.compute()
+    assert torch.isfinite(torch.as_tensor(correlation))
+    assert 0 <= correlation <= 2
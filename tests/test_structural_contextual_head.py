@@ -0,0 +1,37 @@
+from typing import Optional
+
+import pytest
+import torch
+
+from transformer_document_embedding.datasets import col
+from transformer_document_embedding.heads.structural_contextual_head import (
+    StructuralContextualHead,
+)
+
+
+@pytest.mark.parametrize("max_structural_length", [None, 25])
+def test_weighted_contrastive_structural_loss(
+    max_structural_length: Optional[int],
+) -> None:
+    head = StructuralContextualHead(
+        lam=0.3,
+        max_structural_length=max_structural_length,
+        contextual_head_kwargs=None,
+        structural_head_kwargs={"loss_type": "contrastive"},
+        embedding_model=None,
+    )
+
+    batch_size = 4
+    outputs = head(
+        **{
+            col.EMBEDDING: torch.randn(batch_size, 8),
+            col.LENGTH: torch.tensor([10, 20, 30, 40]),
+            col.STRUCTURAL_EMBED: torch.randn(batch_size, 8),
+        }
+    )
+
+    assert outputs["structural_loss"].shape == (batch_size,)
+    assert outputs["loss"].dim() == 0
+    assert torch.isfinite(outputs["loss"])
+    if max_structural_length is not None:
+        assert (outputs["structural_loss"][2:] == 0).all()